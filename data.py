@@ -1,14 +1,20 @@
-import itertools
 import os
+import copy
+from collections import OrderedDict
 
 import torch
+import torch.multiprocessing as mp
 import numpy as np
+from torch.utils.data import Sampler, IterableDataset, get_worker_info
 from torch_geometric.data import Dataset
 from torch_geometric.data import Data
-from torch_geometric.data.collate import collate
+from torch_geometric.data import Batch
 
 import constants
 from constants import EdgeTypes
+from packing import pack_structure, unpack_structure
+from packing import popcount, next_set_bit, or_tracks, and_tracks
+from shards import SongShardReader, is_song_dataset
 
 
 def get_node_labels(s_tensor, ones_idxs):
@@ -21,40 +27,48 @@ def get_node_labels(s_tensor, ones_idxs):
     return labels
 
 
-def get_track_edges(s_tensor, ones_idxs=None, node_labels=None):
+def _sort_edges(edges, keys):
+    # Reorder edges according to (unique) integer keys
+    perm = torch.argsort(keys)
+    return edges[perm]
 
-    track_edges = []
+
+# The functions below build edges for a whole (n_bars x n_tracks x n_timesteps)
+# structure tensor at once. Nodes are labelled in (bar, track, timestep) order,
+# which corresponds to the order of torch.nonzero. Edges never cross bars and
+# are returned as (n_edges x 4) tensors of (u, v, type, ts_distance) tuples,
+# grouped by bar and ordered as in the original per-bar construction.
+
+def get_track_edges(s_tensor, ones_idxs=None):
 
     if ones_idxs is None:
         # Indices where the binary structure tensor is active
         ones_idxs = torch.nonzero(s_tensor, as_tuple=True)
 
-    if node_labels is None:
-        node_labels = get_node_labels(s_tensor, ones_idxs)
+    bars, tracks, tss = ones_idxs
+    n_nodes = bars.size(0)
+
+    # Consecutive active timesteps of the same track in the same bar have
+    # consecutive node labels
+    consecutive = (bars[1:] == bars[:-1]) & (tracks[1:] == tracks[:-1])
+    u = torch.nonzero(consecutive, as_tuple=True)[0]
+    v = u + 1
+
+    # Edges in different tracks have different types
+    edge_types = EdgeTypes.TRACK.value + tracks[u]
+    dists = tss[v] - tss[u]
 
-    # For each track, add direct and inverse edges between consecutive nodes
-    for track in range(s_tensor.size(0)):
-        # List of active timesteps in the current track
-        tss = list(ones_idxs[1][ones_idxs[0] == track])
-        edge_type = EdgeTypes.TRACK.value + track
-        edges = [
-            # Edge tuple: (u, v, type, ts_distance). Zip is used to obtain
-            # consecutive active timesteps. Edges in different tracks have
-            # different types.
-            (node_labels[track, t1],
-             node_labels[track, t2], edge_type, t2 - t1)
-            for t1, t2 in zip(tss[:-1], tss[1:])
-        ]
-        inverse_edges = [(u, v, t, d) for (v, u, t, d) in edges]
-        track_edges.extend(edges + inverse_edges)
+    edges = torch.stack((u, v, edge_types, dists), dim=1)
+    inverse_edges = torch.stack((v, u, edge_types, dists), dim=1)
 
-    return torch.tensor(track_edges, dtype=torch.long)
+    # For each (bar, track), direct edges come before inverse edges
+    group = (bars[u] * s_tensor.size(1) + tracks[u]) * 2
+    keys = torch.cat((group * n_nodes + u, (group + 1) * n_nodes + u))
 
+    return _sort_edges(torch.cat((edges, inverse_edges)), keys)
 
-def get_onset_edges(s_tensor, ones_idxs=None, node_labels=None):
 
-    onset_edges = []
-    edge_type = EdgeTypes.ONSET.value
+def get_onset_edges(s_tensor, ones_idxs=None, node_labels=None, words=None):
 
     if ones_idxs is None:
         # Indices where the binary structure tensor is active
@@ -63,27 +77,40 @@ def get_onset_edges(s_tensor, ones_idxs=None, node_labels=None):
     if node_labels is None:
         node_labels = get_node_labels(s_tensor, ones_idxs)
 
-    # Add direct and inverse edges between nodes played in the same timestep
-    for ts in range(s_tensor.size(1)):
-        # List of active tracks in the current timestep
-        tracks = list(ones_idxs[0][ones_idxs[1] == ts])
-        # Obtain all possible pairwise combinations of active tracks
-        combinations = list(itertools.combinations(tracks, 2))
-        edges = [
-            # Edge tuple: (u, v, type, ts_distance(=0)).
-            (node_labels[track1, ts], node_labels[track2, ts], edge_type, 0)
-            for track1, track2 in combinations
-        ]
-        inverse_edges = [(u, v, t, d) for (v, u, t, d) in edges]
-        onset_edges.extend(edges + inverse_edges)
+    if words is None:
+        words = pack_structure(s_tensor)
 
-    return torch.tensor(onset_edges, dtype=torch.long)
+    n_tracks, n_timesteps = s_tensor.size(1), s_tensor.size(2)
+    device = s_tensor.device
 
+    # All possible pairwise combinations of tracks (track1 < track2)
+    pairs = torch.combinations(torch.arange(n_tracks, device=device), 2)
 
-def get_next_edges(s_tensor, ones_idxs=None, node_labels=None):
+    # Combinations of tracks that are both active in a timestep, listed in
+    # (bar, timestep, combination) order
+    both = unpack_structure(and_tracks(words, pairs), n_timesteps)
+    bars, tss, combs = torch.nonzero(both.permute(0, 2, 1), as_tuple=True)
+    track1, track2 = pairs[combs, 0], pairs[combs, 1]
 
-    next_edges = []
-    edge_type = EdgeTypes.NEXT.value
+    u = node_labels[bars, track1, tss]
+    v = node_labels[bars, track2, tss]
+    edge_types = torch.full_like(u, EdgeTypes.ONSET.value)
+    dists = torch.zeros_like(u)
+
+    # Edge tuple: (u, v, type, ts_distance(=0)).
+    edges = torch.stack((u, v, edge_types, dists), dim=1)
+    inverse_edges = torch.stack((v, u, edge_types, dists), dim=1)
+
+    # For each (bar, timestep), direct edges come before inverse edges
+    n_edges = edges.size(0)
+    group = (bars * n_timesteps + tss) * 2
+    rank = torch.arange(n_edges, device=device)
+    keys = torch.cat((group * n_edges + rank, (group + 1) * n_edges + rank))
+
+    return _sort_edges(torch.cat((edges, inverse_edges)), keys)
+
+
+def get_next_edges(s_tensor, ones_idxs=None, node_labels=None, words=None):
 
     if ones_idxs is None:
         # Indices where the binary structure tensor is active
@@ -92,33 +119,192 @@ def get_next_edges(s_tensor, ones_idxs=None, node_labels=None):
     if node_labels is None:
         node_labels = get_node_labels(s_tensor, ones_idxs)
 
-    # List of active timesteps
-    tss = torch.nonzero(torch.any(s_tensor.bool(), dim=0)).squeeze()
-    if tss.dim() == 0:
-        return torch.tensor([], dtype=torch.long)
+    if words is None:
+        words = pack_structure(s_tensor)
+
+    s_tensor = s_tensor.bool()
+    n_tracks, n_timesteps = s_tensor.size(1), s_tensor.size(2)
+    device = s_tensor.device
 
-    for i in range(tss.size(0)-1):
-        # Get consecutive active timesteps
-        t1, t2 = tss[i], tss[i+1]
-        # Get all the active tracks in the two timesteps
-        t1_tracks = ones_idxs[0][ones_idxs[1] == t1]
-        t2_tracks = ones_idxs[0][ones_idxs[1] == t2]
+    # Active timesteps of each bar, each one paired with the next active
+    # timestep of the same bar (if any)
+    active = or_tracks(words)
+    act_bars, act_tss = torch.nonzero(unpack_structure(active, n_timesteps),
+                                      as_tuple=True)
+    next_tss = next_set_bit(active[act_bars], act_tss + 1)
+    has_next = next_tss >= 0
+    bars = act_bars[has_next]
+    t1, t2 = act_tss[has_next], next_tss[has_next]
 
-        # Combine the source and destination tracks, removing combinations with
-        # the same source and destination track (since these represent track
-        # edges).
-        tracks_product = list(itertools.product(t1_tracks, t2_tracks))
-        tracks_product = [(track1, track2)
-                          for (track1, track2) in tracks_product
-                          if track1 != track2]
-        # Edge tuple: (u, v, type, ts_distance).
-        edges = [(node_labels[track1, t1], node_labels[track2, t2],
-                  edge_type, t2 - t1)
-                 for track1, track2 in tracks_product]
+    # Combine the source and destination tracks, removing combinations with
+    # the same source and destination track (since these represent track
+    # edges).
+    not_same = ~torch.eye(n_tracks, dtype=torch.bool, device=device)
+    products = (s_tensor[bars, :, t1].unsqueeze(2) &
+                s_tensor[bars, :, t2].unsqueeze(1) & not_same)
+    pair_idxs, track1, track2 = torch.nonzero(products, as_tuple=True)
+    bars, t1, t2 = bars[pair_idxs], t1[pair_idxs], t2[pair_idxs]
 
-        next_edges.extend(edges)
+    # Edge tuple: (u, v, type, ts_distance).
+    u = node_labels[bars, track1, t1]
+    v = node_labels[bars, track2, t2]
+    edge_types = torch.full_like(u, EdgeTypes.NEXT.value)
 
-    return torch.tensor(next_edges, dtype=torch.long)
+    return torch.stack((u, v, edge_types, t2 - t1), dim=1)
+
+
+def get_edges(s_tensor, ones_idxs=None, words=None):
+
+    if ones_idxs is None:
+        # Indices where the binary structure tensor is active
+        ones_idxs = torch.nonzero(s_tensor, as_tuple=True)
+
+    if words is None:
+        words = pack_structure(s_tensor)
+
+    node_labels = get_node_labels(s_tensor, ones_idxs)
+    node_bars = ones_idxs[0]
+    n_bars = s_tensor.size(0)
+    device = s_tensor.device
+
+    # Edge families, each one grouped by bar
+    families = [
+        get_track_edges(s_tensor, ones_idxs),
+        get_onset_edges(s_tensor, ones_idxs, node_labels, words),
+        get_next_edges(s_tensor, ones_idxs, node_labels, words)
+    ]
+    edges = torch.cat(families)
+    family = torch.cat([torch.full((len(f),), i, dtype=torch.long,
+                                   device=device)
+                        for i, f in enumerate(families)])
+    edge_bars = node_bars[edges[:, 0]]
+
+    # If a bar has no edges (i.e. it has a single node), add a fake self-edge
+    n_bar_edges = torch.bincount(edge_bars, minlength=n_bars)
+    n_bar_nodes = popcount(words).sum(dim=-1)
+    edgeless = torch.nonzero(n_bar_edges == 0, as_tuple=True)[0]
+    first_nodes = torch.cumsum(n_bar_nodes, dim=0) - n_bar_nodes
+    self_loops = first_nodes[edgeless]
+    zeros = torch.zeros_like(self_loops)
+    edges = torch.cat(
+        (edges, torch.stack((self_loops, self_loops, zeros, zeros), dim=1)))
+    family = torch.cat((family, zeros))
+    edge_bars = torch.cat((edge_bars, edgeless))
+
+    # Each bar lists its track edges, then its onset edges and finally its
+    # next edges
+    n_edges = edges.size(0)
+    keys = ((edge_bars * len(families) + family) * n_edges +
+            torch.arange(n_edges, device=device))
+
+    return _sort_edges(edges, keys)
+
+
+class BarGraphCache():
+
+    def __init__(self, max_bytes=32 * 2**20):
+        # LRU cache mapping the packed activation pattern of a bar to the
+        # edges of its graph (local node labels), bounded by max_bytes
+        self.max_bytes = max_bytes
+        self.n_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _entry_size(self, key, edges):
+        # Approximate memory footprint of a cache entry
+        return len(key[1]) + edges.element_size() * edges.numel() + 128
+
+    def get(self, key):
+        edges = self._entries.get(key)
+        if edges is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return edges
+
+    def put(self, key, edges):
+        size = self._entry_size(key, edges)
+        if key in self._entries or size > self.max_bytes:
+            return
+        self._entries[key] = edges
+        self.n_bytes += size
+
+        # Evict least recently used entries
+        while self.n_bytes > self.max_bytes:
+            old_key, old_edges = self._entries.popitem(last=False)
+            self.n_bytes -= self._entry_size(old_key, old_edges)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups > 0 else 0.,
+            'entries': len(self._entries),
+            'bytes': self.n_bytes
+        }
+
+
+def get_cached_edges(s_tensor, cache, words=None):
+
+    # Same as get_edges, but the edges of each distinct bar pattern are
+    # taken from the cache (or built and cached if missing). s_tensor must
+    # not contain empty bars.
+    device = s_tensor.device
+    n_bars = s_tensor.size(0)
+    n_timesteps = s_tensor.size(-1)
+
+    # Distinct packed bar patterns
+    if words is None:
+        words = pack_structure(s_tensor)
+    words = words.cpu()
+    patterns, inverse = torch.unique(words, dim=0, return_inverse=True)
+    keys = [(n_timesteps, p.tobytes()) for p in patterns.numpy()]
+
+    bar_edges = [cache.get(key) for key in keys]
+    missing = [i for i, edges in enumerate(bar_edges) if edges is None]
+
+    if missing:
+        # Build the edges of all the missing patterns at once and split them
+        # into per-bar edges with local node labels
+        missing_bars = unpack_structure(patterns[missing], n_timesteps)
+        ones_idxs = torch.nonzero(missing_bars, as_tuple=True)
+        edges = get_edges(missing_bars, ones_idxs, patterns[missing])
+        node_bars = ones_idxs[0]
+        n_bar_nodes = torch.bincount(node_bars, minlength=len(missing))
+        first_nodes = torch.cumsum(n_bar_nodes, dim=0) - n_bar_nodes
+        edge_bars = node_bars[edges[:, 0]]
+        edges[:, :2] -= first_nodes[edge_bars].unsqueeze(1)
+        n_bar_edges = torch.bincount(edge_bars, minlength=len(missing))
+        split = torch.split(edges.to(torch.int16), n_bar_edges.tolist())
+        for i, edges in zip(missing, split):
+            cache.put(keys[i], edges)
+            bar_edges[i] = edges
+
+    # Assemble the edges of each bar from the edges of its pattern,
+    # offsetting local node labels by the index of the bar's first node
+    n_pattern_edges = torch.tensor([len(e) for e in bar_edges],
+                                   dtype=torch.long)
+    pattern_edges = torch.cat(bar_edges).long()
+    pattern_starts = torch.cumsum(n_pattern_edges, dim=0) - n_pattern_edges
+
+    n_bar_edges = n_pattern_edges[inverse]
+    edge_bars = torch.repeat_interleave(torch.arange(n_bars), n_bar_edges)
+    bar_starts = torch.cumsum(n_bar_edges, dim=0) - n_bar_edges
+    pos = (torch.arange(edge_bars.size(0)) - bar_starts[edge_bars] +
+           pattern_starts[inverse][edge_bars])
+    edges = pattern_edges[pos]
+
+    n_bar_nodes = popcount(words).sum(dim=1)
+    first_nodes = torch.cumsum(n_bar_nodes, dim=0) - n_bar_nodes
+    edges[:, :2] += first_nodes[edge_bars].unsqueeze(1)
+
+    return edges.to(device)
 
 
 def get_track_features(s_tensor):
@@ -127,145 +313,708 @@ def get_track_features(s_tensor):
     ones_idxs = torch.nonzero(s_tensor)
 
     n_nodes = len(ones_idxs)
-    tracks = ones_idxs[:, 0]
-    n_tracks = s_tensor.size(0)
+    tracks = ones_idxs[:, -2]
+    n_tracks = s_tensor.size(-2)
 
     # The feature n_nodes x n_tracks tensor contains one-hot tracks
     # representations for each node
-    features = torch.zeros((n_nodes, n_tracks))
-    features[torch.arange(n_nodes), tracks] = 1
+    features = torch.zeros((n_nodes, n_tracks), device=s_tensor.device)
+    features[torch.arange(n_nodes, device=s_tensor.device), tracks] = 1
 
     return features
 
 
-def graph_from_tensor(s_tensor):
-
-    bars = []
-
-    # Iterate over bars and construct a graph for each bar
-    for i in range(s_tensor.size(0)):
-
-        bar = s_tensor[i]
-
-        # If the bar contains no activations, add a fake one to avoid having 
-        # to deal with empty graphs
-        if not torch.any(bar):
-            bar[0, 0] = 1
-
-        # Get edges from boolean activations
-        track_edges = get_track_edges(bar)
-        onset_edges = get_onset_edges(bar)
-        next_edges = get_next_edges(bar)
-        edges = [track_edges, onset_edges, next_edges]
-
-        # Concatenate edge tensors (N x 4) (if any)
-        is_edgeless = (len(track_edges) == 0 and
-                       len(onset_edges) == 0 and
-                       len(next_edges) == 0)
-        if not is_edgeless:
-            edge_list = torch.cat([x for x in edges
-                                   if torch.numel(x) > 0])
-
-        # Adapt tensor to torch_geometric's Data
-        # If no edges, add fake self-edge
-        # edge_list[:, :2] contains source and destination node labels
-        # edge_list[:, 2:] contains edge types and timestep distances
-        edge_index = (edge_list[:, :2].t().contiguous() if not is_edgeless else
-                      torch.LongTensor([[0], [0]]))
-        attrs = (edge_list[:, 2:] if not is_edgeless else
-                 torch.Tensor([[0, 0]]))
-
-        # Add one hot timestep distance to edge attributes
-        edge_attrs = torch.zeros(attrs.size(0), s_tensor.shape[-1] + 1)
-        edge_attrs[:, 0] = attrs[:, 0]
-        edge_attrs[torch.arange(edge_attrs.size(0)),
-                   attrs.long()[:, 1] + 1] = 1
-
-        node_features = get_track_features(bar)
-        is_drum = node_features[:, 0].bool()
-        num_nodes = torch.sum(bar, dtype=torch.long)
-
-        bars.append(Data(edge_index=edge_index, edge_attrs=edge_attrs,
-                         num_nodes=num_nodes, node_features=node_features,
-                         is_drum=is_drum).to(s_tensor.device))
-
-    # Merge the graphs corresponding to different bars into a single big graph
-    graph, _, _ = collate(
-        Data,
-        data_list=bars,
-        increment=True,
-        add_batch=True
-    )
-
-    # Change bars assignment vector name (otherwise, Dataloader's collate
-    # would overwrite graphs.batch)
-    graph.bars = graph.batch
+def _bar_graphs(s_tensor, cache=None, edge_list=None, words=None):
+
+    # If a bar contains no activations, add a fake one to avoid having
+    # to deal with empty graphs
+    empty = ~torch.any(torch.any(s_tensor.bool(), dim=-1), dim=-1)
+    s_tensor[empty, 0, 0] = 1
+
+    bar = s_tensor.bool()
+
+    # Packed structure (n_bars x n_tracks), used to build the edges. It can
+    # be given by the caller if it is already available.
+    if words is None:
+        words = pack_structure(bar)
+    elif torch.any(empty):
+        words = words.clone()
+        words[empty, 0] |= 1
+
+    # Get edges from boolean activations for all the bars at once. The
+    # resulting graph is the union of the (disconnected) bar graphs.
+    # Edges can also be precomputed (see graph_edges).
+    ones_idxs = torch.nonzero(bar, as_tuple=True)
+    if edge_list is not None:
+        edge_list = edge_list.long()
+    elif cache is None:
+        edge_list = get_edges(bar, ones_idxs, words)
+    else:
+        edge_list = get_cached_edges(bar, cache, words)
+
+    # Adapt tensor to torch_geometric's Data
+    # edge_list[:, :2] contains source and destination node labels
+    # edge_list[:, 2:] contains edge types and timestep distances, which are
+    # stored as small integers (types < N_EDGE_TYPES, distances < n_timesteps)
+    edge_index = edge_list[:, :2].t().contiguous()
+    edge_type = edge_list[:, 2].to(torch.uint8)
+    edge_dist = edge_list[:, 3].to(torch.uint8)
+
+    node_features = get_track_features(bar)
+    is_drum = node_features[:, 0].bool()
+
+    return {
+        'edge_index': edge_index,
+        'edge_type': edge_type,
+        'edge_dist': edge_dist,
+        'num_nodes': ones_idxs[0].size(0),
+        'node_features': node_features,
+        'is_drum': is_drum,
+        'bars': ones_idxs[0]
+    }
+
+
+def _ptr_from_index(index, size):
+    counts = torch.bincount(index, minlength=size)
+    zero = torch.zeros(1, dtype=torch.long, device=index.device)
+    return torch.cat((zero, torch.cumsum(counts, dim=0)))
+
+
+def graph_edges(s_tensor):
+
+    # Number of nodes and edge list of the graph built from a
+    # (n_bars x n_tracks x n_timesteps) structure tensor. The edge list
+    # (n_edges x 4: source, destination, type and distance) can be stored and
+    # passed back to graph_from_tensor to skip the computation of edges.
+    attrs = _bar_graphs(s_tensor.clone())
+    edge_list = torch.cat([attrs['edge_index'].t(),
+                           attrs['edge_type'].long().unsqueeze(1),
+                           attrs['edge_dist'].long().unsqueeze(1)], dim=1)
+
+    return attrs['num_nodes'], edge_list
+
+
+def graph_from_tensor(s_tensor, cache=None, edge_list=None):
+
+    # s_tensor: n_bars x n_tracks x n_timesteps
+    # If a BarGraphCache is provided, bar edges are looked up by pattern.
+    # If edge_list is provided (see graph_edges), edges are not computed.
+    graph = Data(**_bar_graphs(s_tensor, cache, edge_list))
+
+    # The bar assignment vector is stored both as `batch` and `bars`
+    # (otherwise, Dataloader's collate would overwrite graphs.batch)
+    graph.batch = graph.bars
+    graph.ptr = _ptr_from_index(graph.bars, s_tensor.size(0))
 
     return graph
 
 
+def batch_from_tensor(s_tensor, cache=None, words=None):
+
+    # s_tensor: bs x n_bars x n_tracks x n_timesteps
+    # words: optional packed s_tensor (bs x n_bars x n_tracks)
+    # All the bars in the batch are processed together, as if they were the
+    # bars of a single (bs*n_bars) sequence. The batch and bar assignment
+    # vectors are then recovered from the flat bar indices.
+    bs, n_bars = s_tensor.size(0), s_tensor.size(1)
+    bars = s_tensor.reshape(bs * n_bars, *s_tensor.shape[2:])
+    if words is not None:
+        words = words.reshape(bs * n_bars, words.size(-1))
+    attrs = _bar_graphs(bars, cache, words=words)
+
+    flat_bars = attrs.pop('bars')
+    batch = flat_bars // n_bars
+    attrs['bars'] = flat_bars - batch * n_bars
+
+    return Batch(batch=batch, ptr=_ptr_from_index(batch, bs), **attrs)
+
+
+def batch_from_packed(words, n_timesteps, cache=None):
+
+    # words: bs x n_bars x n_tracks packed structure tensor. Edges are built
+    # from the words, without packing the unpacked tensor again.
+    return batch_from_tensor(unpack_structure(words, n_timesteps), cache,
+                             words)
+
+
+def save_split(path, split):
+
+    # split: list of arrays with the sample indices of each part
+    np.savez(path, *split)
+
+
+def load_split(path):
+
+    with np.load(path) as f:
+        return [f['arr_{}'.format(i)] for i in range(len(f.files))]
+
+
+# Attributes of the graphs of PolyphemusDataset, concatenated by
+# collate_graphs along with edge_index
+NODE_KEYS = ['node_features', 'is_drum', 'bars', 'c_tensor']
+EDGE_KEYS = ['edge_type', 'edge_dist']
+BAR_KEYS = ['s_tensor']
+
+
+def _cat(tensors, dim=0):
+
+    out = None
+    if get_worker_info() is not None:
+        # In DataLoader workers, concatenate directly into shared memory to
+        # avoid a copy when the batch is sent to the main process
+        size = list(tensors[0].size())
+        size[dim] = sum(t.size(dim) for t in tensors)
+        numel = int(np.prod(size))
+        storage = tensors[0].storage()._new_shared(numel)
+        out = tensors[0].new(storage).resize_(size)
+
+    return torch.cat(tensors, dim=dim, out=out)
+
+
+def collate_graphs(data_list):
+
+    # Collate function for the graphs of PolyphemusDataset (to be used as the
+    # collate_fn of a torch DataLoader). Unlike the generic torch_geometric
+    # collation, attributes are known in advance and each one is
+    # concatenated with a single op.
+    # Attribute lookups on Data objects are slow, plain dicts are used instead
+    data_list = [data.to_dict() for data in data_list]
+
+    num_nodes = torch.tensor([data['num_nodes'] for data in data_list])
+    num_edges = torch.tensor([data['edge_index'].size(1)
+                              for data in data_list])
+    ptr = torch.cat([num_nodes.new_zeros(1), torch.cumsum(num_nodes, dim=0)])
+
+    batch = torch.repeat_interleave(torch.arange(len(data_list)), num_nodes)
+    edge_index = _cat([data['edge_index'] for data in data_list], dim=1)
+    edge_index += torch.repeat_interleave(ptr[:-1], num_edges)
+
+    attrs = {key: _cat([data[key] for data in data_list])
+             for key in NODE_KEYS + EDGE_KEYS + BAR_KEYS}
+
+    return Batch(batch=batch, ptr=ptr, edge_index=edge_index,
+                 num_nodes=int(ptr[-1]), **attrs)
+
+
+def transpose_batch(batch, shifts):
+
+    # Transpose the pitches of each graph of a collated batch by the given
+    # number of semitones (shifts: num_graphs tensor), clipping them to the
+    # valid pitch range. Drums and SOS, EOS and PAD tokens are not changed.
+    pitches = batch.c_tensor[..., 0]
+    node_shifts = shifts[batch.batch].unsqueeze(1)
+    mask = ((pitches <= constants.MAX_PITCH_TOKEN) &
+            ~batch.is_drum.unsqueeze(1))
+    transposed = torch.clamp(pitches + node_shifts, 0,
+                             constants.MAX_PITCH_TOKEN)
+    batch.c_tensor[..., 0] = torch.where(mask, transposed, pitches)
+
+    return batch
+
+
+class RandomTranspose():
+
+    # Collate function that collates graphs with collate_fn and randomly
+    # transposes each graph of the batch by a shift in [low, high] semitones.
+    # Shifts are drawn from a random state that depends on the seed, the
+    # epoch (see set_epoch) and the DataLoader worker, so that every epoch
+    # sees new transpositions while runs remain reproducible.
+    def __init__(self, collate_fn=collate_graphs, low=-5, high=6, seed=None):
+        self.collate_fn = collate_fn
+        self.low = low
+        self.high = high
+        self.seed = (seed if seed is not None
+                     else int(torch.empty((), dtype=torch.int64).random_()))
+        self.epoch = 0
+        self.rng = None
+
+    def set_epoch(self, epoch):
+        # Must be called in the main process before each epoch, since
+        # workers get a copy of the collate function
+        self.epoch = epoch
+        self.rng = None
+
+    def __call__(self, data_list):
+
+        if self.rng is None:
+            worker_info = get_worker_info()
+            worker_id = worker_info.id if worker_info is not None else 0
+            self.rng = np.random.default_rng([self.seed, self.epoch,
+                                              worker_id])
+
+        batch = self.collate_fn(data_list)
+        shifts = self.rng.integers(self.low, self.high + 1,
+                                   size=batch.num_graphs)
+
+        return transpose_batch(batch, torch.from_numpy(shifts))
+
+
+def _encode_sample(graph):
+
+    # Serialize a sample of PolyphemusDataset into a uint8 tensor. Only the
+    # structure tensor, the edges and the content tokens are stored, in
+    # compact types, the other node attributes are rebuilt by _decode_sample.
+    s_tensor = graph.s_tensor.bool().numpy()
+    n_edges = graph.edge_index.size(1)
+    header = np.array([graph.num_nodes, n_edges, *s_tensor.shape,
+                       graph.c_tensor.size(1)], dtype=np.int64)
+    fields = [header, s_tensor, graph.edge_index.numpy().astype(np.int32),
+              graph.edge_type.numpy(), graph.edge_dist.numpy(),
+              graph.c_tensor.numpy().astype(np.uint8)]
+
+    buffer = np.concatenate([np.ascontiguousarray(f).reshape(-1).view(np.uint8)
+                             for f in fields])
+
+    return torch.from_numpy(buffer)
+
+
+def _decode_sample(buffer):
+
+    buffer = buffer.numpy()
+    header = buffer[:6*8].view(np.int64)
+    n_nodes, n_edges, n_bars, n_tracks, n_timesteps, n_tokens = header.tolist()
+
+    def read(offset, dtype, shape):
+        size = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        array = buffer[offset:offset+size].view(dtype).reshape(shape)
+        return torch.from_numpy(array.copy()), offset + size
+
+    offset = header.nbytes
+    s_tensor, offset = read(offset, bool, (n_bars, n_tracks, n_timesteps))
+    edge_index, offset = read(offset, np.int32, (2, n_edges))
+    edge_type, offset = read(offset, np.uint8, (n_edges,))
+    edge_dist, offset = read(offset, np.uint8, (n_edges,))
+    c_tensor, offset = read(offset, np.uint8, (n_nodes, n_tokens, 2))
+
+    node_features = get_track_features(s_tensor)
+    bars = torch.nonzero(s_tensor, as_tuple=True)[0]
+    graph = Data(edge_index=edge_index.long(), edge_type=edge_type,
+                 edge_dist=edge_dist, num_nodes=n_nodes,
+                 node_features=node_features,
+                 is_drum=node_features[:, 0].bool(), bars=bars)
+    graph.batch = graph.bars
+    graph.ptr = _ptr_from_index(bars, n_bars)
+    graph.c_tensor = c_tensor.long()
+    graph.s_tensor = s_tensor.float()
+
+    return graph
+
+
+class SampleCache():
+
+    def __init__(self, n_samples, max_bytes=1024 * 2**20):
+        # Cache of the decoded samples (graph and tokens) of a dataset, kept
+        # in shared memory so that it is filled and read by all the
+        # DataLoader workers. It must be created before the workers are
+        # started (with the default multiprocessing start method). Samples
+        # are serialized into a single arena of max_bytes bytes and stay
+        # there until the end of the run: once the arena is full, the samples
+        # that do not fit are simply decoded every time.
+        self.max_bytes = max_bytes
+        self.arena = torch.empty(max_bytes, dtype=torch.uint8).share_memory_()
+        # Offset of each sample in the arena (-1 if missing, -2 if it is
+        # being written) and size of its serialization
+        self.offsets = torch.full((n_samples,), -1,
+                                  dtype=torch.long).share_memory_()
+        self.sizes = torch.zeros(n_samples, dtype=torch.long).share_memory_()
+        # Used bytes, hits and misses
+        self.counters = torch.zeros(3, dtype=torch.long).share_memory_()
+        self.lock = mp.Lock()
+
+    def __len__(self):
+        return int((self.offsets >= 0).sum())
+
+    def get(self, idx):
+
+        offset = int(self.offsets[idx])
+        with self.lock:
+            self.counters[1 if offset >= 0 else 2] += 1
+        if offset < 0:
+            return None
+
+        return _decode_sample(self.arena[offset:offset+int(self.sizes[idx])])
+
+    def put(self, idx, graph):
+
+        buffer = _encode_sample(graph)
+        size = buffer.numel()
+
+        # Reserve space for the sample, then copy it outside of the lock.
+        # The offset is published only once the copy is complete.
+        with self.lock:
+            offset = int(self.counters[0])
+            if self.offsets[idx] != -1 or offset + size > self.max_bytes:
+                return
+            self.counters[0] += size
+            self.offsets[idx] = -2
+
+        self.arena[offset:offset+size] = buffer
+        self.sizes[idx] = size
+        self.offsets[idx] = offset
+
+    def stats(self):
+        used, hits, misses = self.counters.tolist()
+        lookups = hits + misses
+        return {
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': hits / lookups if lookups > 0 else 0.,
+            'entries': len(self),
+            'bytes': used
+        }
+
+
 class PolyphemusDataset(Dataset):
 
-    def __init__(self, dir, n_bars=2):
+    def __init__(self, dir, n_bars=2, graph_cache=None, sample_cache_mb=0):
         self.dir = dir
-        self.files = list(os.scandir(self.dir))
-        self.len = len(self.files)
         self.n_bars = n_bars
+        # Optional BarGraphCache (each DataLoader worker gets its own copy)
+        self.graph_cache = graph_cache
+
+        # Datasets are either song datasets (see shards.py) or stored as one
+        # .npz file per sample (older versions of preprocess.py). In song
+        # datasets, samples are the windows of n_bars bars of the subsongs
+        # that pass the silence filters, and a manifest with the metadata of
+        # each sample is built here.
+        self.manifest = None
+        self.windows = None
+        if is_song_dataset(self.dir):
+            self.shards = SongShardReader(self.dir)
+            self.windows, self.manifest = self.shards.windows(n_bars)
+            n_samples = len(self.windows)
+        else:
+            self.shards = None
+            self.files = list(os.scandir(self.dir))
+            n_samples = len(self.files)
+
+        # Samples in the dataset. Filtered views and splits of the dataset
+        # share everything except the indices of their samples.
+        self.indices = np.arange(n_samples)
+        # Graph sizes measured by graph_sizes (shared by all the views)
+        self.measured_sizes = {}
+        # Optional cache of decoded samples, shared by all the views and by
+        # the DataLoader workers
+        self.sample_cache = (SampleCache(n_samples, sample_cache_mb * 2**20)
+                             if sample_cache_mb > 0 else None)
 
     def __len__(self):
-        return self.len
+        return len(self.indices)
+
+    def _view(self, indices):
+        view = copy.copy(self)
+        view.indices = indices
+        return view
+
+    def filter(self, **kwargs):
+
+        # View of the dataset with the samples that satisfy the conditions
+        # on the manifest metadata (see Manifest.select)
+        if self.manifest is None:
+            raise ValueError("Dataset {} has no manifest".format(self.dir))
+
+        mask = self.manifest.select(**kwargs)
+
+        return self._view(self.indices[mask[self.indices]])
+
+    def split(self, lengths, path=None):
+
+        # Randomly split the dataset into non-overlapping views with the
+        # given lengths (similarly to torch.utils.data.random_split). If path
+        # exists, the split is loaded from it, otherwise the new split is
+        # saved to path (if set), so that it can be reused across runs.
+        if sum(lengths) != len(self):
+            raise ValueError("The sum of the split lengths does not match "
+                             "the length of the dataset")
+
+        if path is not None and os.path.exists(path):
+            split = load_split(path)
+            # The loaded split must have been made for the same dataset and
+            # the same number of parts (e.g. with or without a validation set)
+            if len(split) != len(lengths):
+                raise ValueError(f"The split in {path} has {len(split)} "
+                                 f"parts, but {len(lengths)} were requested")
+            if (sum(len(indices) for indices in split) != len(self) or
+                    not all(np.isin(indices, self.indices).all()
+                            for indices in split)):
+                raise ValueError(f"The split in {path} does not match the "
+                                 f"samples of the dataset")
+            return [self._view(indices) for indices in split]
+
+        perm = self.indices[torch.randperm(len(self)).numpy()]
+        offsets = np.cumsum([0] + list(lengths))
+        split = [perm[offsets[i]:offsets[i+1]] for i in range(len(lengths))]
+        if path is not None:
+            save_split(path, split)
+
+        return [self._view(indices) for indices in split]
+
+    def graph_sizes(self):
+
+        # Number of nodes and edges of the graph of each sample. Sizes are
+        # read from the manifest or, for datasets without one, measured on
+        # the graphs the first time they are needed.
+        if self.manifest is not None:
+            return (self.manifest.n_nodes[self.indices],
+                    self.manifest.n_edges[self.indices])
+
+        for i, idx in enumerate(self.indices):
+            if idx not in self.measured_sizes:
+                graph = self[i]
+                self.measured_sizes[idx] = (graph.num_nodes,
+                                            graph.edge_index.size(1))
+
+        sizes = np.array([self.measured_sizes[idx] for idx in self.indices],
+                         dtype=np.int64).reshape(-1, 2)
+
+        return sizes[:, 0], sizes[:, 1]
+
+    def sample_shards(self):
+
+        # Shard of each sample of the view (for song datasets)
+        return self.shards.shard_of(self.windows[self.indices])
+
+    def _load(self, idx):
+
+        # Returns the content tensor
+        # (n_bars x n_tracks x n_timesteps x MAX_SIMU_TOKENS x 2), the boolean
+        # structure tensor (n_bars x n_tracks x n_timesteps) and the edge list
+        # of sample idx (None if edges were not precomputed). Song datasets
+        # only store the content of the active timesteps, so their content
+        # tensor is n_nodes x MAX_SIMU_TOKENS x 2.
+        idx = int(self.indices[idx])
+
+        if self.windows is not None:
+            c_tensor, s_tensor, edges, bar_n_edges = self.shards.window(
+                self.windows[idx], self.n_bars)
+            if edges is not None:
+                # From bar to sample node labels
+                edges = edges.astype(np.int64)
+                bar_n_nodes = s_tensor.sum(axis=(1, 2))
+                first_nodes = np.cumsum(bar_n_nodes) - bar_n_nodes
+                edges[:, :2] += np.repeat(first_nodes, bar_n_edges)[:, None]
+            return c_tensor, s_tensor, edges
 
-    def __getitem__(self, idx):
-
-        # Load tensors
         sample_path = os.path.join(self.dir, self.files[idx].name)
         data = np.load(sample_path)
-        c_tensor = torch.tensor(data["c_tensor"], dtype=torch.long)
-        s_tensor = torch.tensor(data["s_tensor"], dtype=torch.bool)
+        c_tensor, s_tensor, edges = data["c_tensor"], data["s_tensor"], None
+        n_timesteps = c_tensor.shape[1] // self.n_bars
 
         # From (n_tracks x n_timesteps x ...)
         # to (n_bars x n_tracks x n_timesteps x ...)
-        c_tensor = c_tensor.reshape(c_tensor.shape[0], self.n_bars, -1,
-                                    c_tensor.shape[2], c_tensor.shape[3])
-        c_tensor = c_tensor.permute(1, 0, 2, 3, 4)
+        c_tensor = c_tensor.reshape(c_tensor.shape[0], self.n_bars,
+                                    n_timesteps, *c_tensor.shape[2:])
+        c_tensor = c_tensor.transpose(1, 0, 2, 3, 4)
         s_tensor = s_tensor.reshape(s_tensor.shape[0], self.n_bars, -1)
-        s_tensor = s_tensor.permute(1, 0, 2)
-
-        # From decimals to onehot (pitches)
-        pitches = c_tensor[..., 0]
-        onehot_p = torch.zeros(
-            (pitches.shape[0]*pitches.shape[1]*pitches.shape[2]*pitches.shape[3],
-             constants.N_PITCH_TOKENS),
-            dtype=torch.float32
-        )
-        onehot_p[torch.arange(0, onehot_p.shape[0]), pitches.reshape(-1)] = 1.
-        onehot_p = onehot_p.reshape(pitches.shape[0], pitches.shape[1],
-                                    pitches.shape[2], pitches.shape[3],
-                                    constants.N_PITCH_TOKENS)
-
-        # From decimals to onehot (durations)
-        durs = c_tensor[..., 1]
-        onehot_d = torch.zeros(
-            (durs.shape[0]*durs.shape[1]*durs.shape[2]*durs.shape[3],
-             constants.N_DUR_TOKENS),
-            dtype=torch.float32
-        )
-        onehot_d[torch.arange(0, onehot_d.shape[0]), durs.reshape(-1)] = 1.
-        onehot_d = onehot_d.reshape(durs.shape[0], durs.shape[1],
-                                    durs.shape[2], durs.shape[3],
-                                    constants.N_DUR_TOKENS)
-
-        # Concatenate pitches and durations
-        c_tensor = torch.cat((onehot_p, onehot_d), dim=-1)
+        s_tensor = s_tensor.transpose(1, 0, 2)
+
+        return c_tensor, s_tensor, edges
+
+    def __getitem__(self, idx):
+
+        if self.sample_cache is None:
+            return self._get(idx)
+
+        key = int(self.indices[idx])
+        graph = self.sample_cache.get(key)
+        if graph is None:
+            graph = self._get(idx)
+            self.sample_cache.put(key, graph)
+
+        return graph
+
+    def _get(self, idx):
+
+        # Load tensors (and edges, if they were precomputed)
+        c_tensor, s_tensor, edges = self._load(idx)
+        c_tensor = torch.tensor(c_tensor, dtype=torch.long)
+        s_tensor = torch.tensor(s_tensor, dtype=torch.bool)
+        if edges is not None:
+            edges = torch.from_numpy(edges.astype(np.int64))
 
         # Build graph structure from structure tensor
-        graph = graph_from_tensor(s_tensor)
+        graph = graph_from_tensor(s_tensor, self.graph_cache, edges)
 
-        # Filter silences in order to get a sparse representation
-        c_tensor = c_tensor.reshape(-1, c_tensor.shape[-2], c_tensor.shape[-1])
-        c_tensor = c_tensor[s_tensor.reshape(-1).bool()]
+        # Filter silences in order to get a sparse representation. Content
+        # is kept as (pitch, duration) token ids: n_nodes x MAX_SIMU_TOKENS x 2
+        # (content from song datasets is already sparse, and their windows
+        # have no empty bars, hence no fake activations)
+        if c_tensor.dim() > 3:
+            c_tensor = c_tensor.reshape(-1, c_tensor.shape[-2],
+                                        c_tensor.shape[-1])
+            c_tensor = c_tensor[s_tensor.reshape(-1).bool()]
 
         graph.c_tensor = c_tensor
         graph.s_tensor = s_tensor.float()
 
         return graph
+
+
+class BucketBatchSampler(Sampler):
+
+    # Batch sampler that forms batches of samples with a similar graph size
+    # under a budget of nodes (and, optionally, edges). Samples are grouped
+    # into n_buckets buckets by number of nodes. At each epoch, the samples
+    # of each bucket are shuffled and packed greedily into batches until the
+    # budget is reached, and the order of the batches is shuffled. The samples
+    # left at the end of a bucket are carried over to the next one. Batches
+    # hold at least two samples (batch normalization needs more than one
+    # value per channel) unless there is a single sample: a sample that
+    # exceeds the budget by itself is batched with the next one, and a last
+    # batch of one sample is merged into the previous batch (or dropped with
+    # drop_last).
+    # Can be used as the batch_sampler of a DataLoader. The batches of an
+    # epoch only change when set_epoch is called.
+    def __init__(self, n_nodes, n_edges=None, max_nodes=8192, max_edges=None,
+                 n_buckets=16, shuffle=True, drop_last=False, seed=None):
+        self.n_nodes = np.asarray(n_nodes)
+        self.n_edges = np.asarray(n_edges) if n_edges is not None else None
+        self.max_nodes = max_nodes
+        self.max_edges = max_edges
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.seed = (seed if seed is not None
+                     else int(torch.empty((), dtype=torch.int64).random_()))
+        self.epoch = 0
+        self.batches = None
+
+        # Buckets are node count quantiles
+        order = np.argsort(self.n_nodes, kind='stable')
+        self.buckets = [b for b in np.array_split(order, n_buckets)
+                        if len(b) > 0]
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+        self.batches = None
+
+    def _make_batches(self):
+
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+
+        batches = []
+        batch, nodes, edges = [], 0, 0
+        for bucket in self.buckets:
+            if self.shuffle:
+                bucket = bucket[torch.randperm(len(bucket),
+                                               generator=generator).numpy()]
+
+            for idx in bucket:
+                n = self.n_nodes[idx]
+                e = self.n_edges[idx] if self.n_edges is not None else 0
+                over_nodes = nodes + n > self.max_nodes
+                over_edges = (self.max_edges is not None and
+                              edges + e > self.max_edges)
+                if len(batch) >= 2 and (over_nodes or over_edges):
+                    batches.append(batch)
+                    batch, nodes, edges = [], 0, 0
+                batch.append(int(idx))
+                nodes += n
+                edges += e
+
+        if batch and not self.drop_last:
+            if len(batch) >= 2 or not batches:
+                batches.append(batch)
+            else:
+                batches[-1].extend(batch)
+
+        if self.shuffle:
+            perm = torch.randperm(len(batches), generator=generator).tolist()
+            batches = [batches[i] for i in perm]
+
+        return batches
+
+    def __len__(self):
+        # The number of batches depends on the epoch
+        if self.batches is None:
+            self.batches = self._make_batches()
+        return len(self.batches)
+
+    def __iter__(self):
+
+        if self.batches is None:
+            self.batches = self._make_batches()
+
+        return iter(self.batches)
+
+
+class PolyphemusStream(IterableDataset):
+
+    # Iterable version of a (song) PolyphemusDataset, which reads the
+    # shards sequentially instead of accessing samples at random. Samples are
+    # shuffled at two levels: the order of the shards is shuffled at each
+    # epoch and samples go through a shuffle buffer of buffer_size samples.
+    # Shards are assigned to DataLoader workers in a round-robin fashion
+    # over the shuffled order, so each epoch is fully determined by the seed
+    # and the number of workers. Only the samples of the given dataset view
+    # (e.g. a split) are read, in the order in which they are stored.
+    # Each worker batches its own samples, so that every worker ends the
+    # epoch with a partial batch: these should be dropped with the drop_last
+    # option of the DataLoader.
+    def __init__(self, dataset, shuffle=True, buffer_size=1024, seed=None):
+        if dataset.shards is None:
+            raise ValueError("Dataset {} is not a song dataset".format(
+                dataset.dir))
+
+        self.dataset = dataset
+        self.shuffle = shuffle
+        self.buffer_size = buffer_size
+        self.seed = (seed if seed is not None
+                     else int(torch.empty((), dtype=torch.int64).random_()))
+        self.epoch = 0
+
+        # Positions in the dataset view of the samples of each shard
+        offsets = dataset.shards.offsets
+        order = np.argsort(dataset.indices, kind='stable')
+        shard_ids = dataset.sample_shards()[order]
+        bounds = np.searchsorted(shard_ids, np.arange(len(offsets)))
+        self.shard_samples = [order[bounds[k]:bounds[k+1]]
+                              for k in range(len(offsets) - 1)
+                              if bounds[k+1] > bounds[k]]
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def set_epoch(self, epoch):
+        # Must be called in the main process before each epoch, since
+        # workers get a copy of the dataset
+        self.epoch = epoch
+
+    def _worker_shards(self):
+
+        worker_info = get_worker_info()
+        worker_id = worker_info.id if worker_info is not None else 0
+        n_workers = worker_info.num_workers if worker_info is not None else 1
+
+        shards = np.arange(len(self.shard_samples))
+        if self.shuffle:
+            generator = torch.Generator()
+            generator.manual_seed(self.seed + self.epoch)
+            shards = shards[torch.randperm(len(shards),
+                                           generator=generator).numpy()]
+
+        # Random state of the shuffle buffer of this worker
+        rng = np.random.default_rng([self.seed, self.epoch, worker_id])
+
+        return shards[worker_id::n_workers], rng
+
+    def __iter__(self):
+
+        shards, rng = self._worker_shards()
+
+        buffer = []
+        for shard in shards:
+            for pos in self.shard_samples[shard]:
+                graph = self.dataset[pos]
+                if not self.shuffle:
+                    yield graph
+                elif len(buffer) < self.buffer_size:
+                    buffer.append(graph)
+                else:
+                    # Replace a random sample of the buffer
+                    i = rng.integers(len(buffer))
+                    yield buffer[i]
+                    buffer[i] = graph
+
+        for i in rng.permutation(len(buffer)):
+            yield buffer[i]
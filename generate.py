@@ -14,6 +14,7 @@ from model import VAE
 from utils import set_seed
 from utils import mtp_from_logits, muspy_from_mtp, set_seed
 from utils import print_divider
+from packing import pack_structure, unpack_structure, or_tracks
 from utils import loop_muspy_music, save_midi, save_audio
 from plots import plot_pianoroll, plot_structure
 
@@ -215,26 +216,30 @@ def main():
             elif dims[0] > n_bars:
                 raise ValueError(f"First structure tensor dimension {dims[0]} "
                                  f"is higher than {n_bars}")
-            else:
-                # Repeat partial structure tensor
-                r = math.ceil(n_bars / dims[0])
-                s_tensor = s_tensor.repeat(r, 1, 1)
-                s_tensor = s_tensor[:n_bars, ...]
+
+        # Pack the structure tensor (n_bars x n_tracks words)
+        s_words = pack_structure(s_tensor)
+
+        if dims[0] < n_bars:
+            # Repeat partial structure tensor
+            r = math.ceil(n_bars / dims[0])
+            s_words = s_words.repeat(r, 1)
+            s_words = s_words[:n_bars, ...]
         
         # Avoid empty bars by creating a fake activation for each empty
-        # (n_tracks x n_timesteps) bar matrix in position [0, 0]
-        empty_mask = ~s_tensor.any(dim=-1).any(dim=-1)
+        # bar in position [0, 0]
+        empty_mask = or_tracks(s_words) == 0
         if empty_mask.any():
             print("The provided structure tensor contains empty bars. Fake "
                   "track activations will be created to avoid processing "
                   "empty bars.")
-        idxs = torch.nonzero(empty_mask, as_tuple=True)
-        s_tensor[idxs + (0, 0)] = True
+        s_words[..., 0] |= empty_mask.long()
         
         # Repeat structure along new batch dimension
-        s_tensor = s_tensor.unsqueeze(0).repeat(args.n, 1, 1, 1)
+        s_words = s_words.unsqueeze(0).repeat(args.n, 1, 1)
         
-        s = model.decoder._structure_from_binary(s_tensor)
+        s = model.decoder._structure_from_packed(s_words, n_timesteps)
+        s_tensor = unpack_structure(s_words, n_timesteps).to(device)
 
     print()
     print("Generating z...")
@@ -244,6 +249,9 @@ def main():
     s_t = time.time()
     mtp, s_tensor = generate_music(model, z, s, s_tensor)
     print("Inference time: {:.3f} s".format(time.time() - s_t))
+    stats = model.decoder.graph_cache.stats()
+    print("Bar graph cache hit rate: {:.2f} ({} hits, {} misses)".format(
+        stats['hit_rate'], stats['hits'], stats['misses']))
 
     print()
     print("Saving MIDI files in {}...\n".format(output_dir))
@@ -8,11 +8,11 @@ from torch_geometric.typing import OptTensor, Adj
 from torch_geometric.nn.inits import reset
 from torch_geometric.nn.norm import BatchNorm
 from torch_geometric.nn.glob import GlobalAttention
-from torch_geometric.data import Batch
 from torch_geometric.nn.conv import RGCNConv
 
 import constants
-from data import graph_from_tensor
+from data import batch_from_packed, BarGraphCache
+from packing import pack_structure, unpack_structure, or_tracks
 
 
 @torch.jit._overload
@@ -38,6 +38,22 @@ def masked_edge_attrs(edge_attrs, edge_mask):
     return edge_attrs[edge_mask, :]
 
 
+def typed_slots(edge_index, edge_type, num_nodes, num_relations):
+
+    # Assign each edge to the aggregation slot of its (relation, destination
+    # node) pair. Slots are sorted by relation and then by node, so that the
+    # slots of each relation form a contiguous segment.
+    keys = edge_type * num_nodes + edge_index[1]
+    slot_keys, edge_slots = torch.unique(keys, sorted=True,
+                                         return_inverse=True)
+    slot_nodes = slot_keys % num_nodes
+    rel_counts = torch.bincount(slot_keys // num_nodes,
+                                minlength=num_relations)
+    rel_ptr = [0] + torch.cumsum(rel_counts, dim=0).tolist()
+
+    return edge_slots, slot_nodes, rel_ptr
+
+
 class GCL(RGCNConv):
 
     def __init__(self, in_channels, out_channels, num_relations, nn,
@@ -52,9 +68,17 @@ class GCL(RGCNConv):
     def reset_edge_nn(self):
         reset(self.nn)
 
+    def dist_weights(self, num_dists):
+
+        # Use edge nn to compute the weight tensor of each possible edge
+        # attribute (=onehot timestep distance between nodes). The weights of
+        # an edge are the row corresponding to its timestep distance.
+        onehot_dists = torch.eye(num_dists, device=self.weight.device)
+        return self.nn(onehot_dists)
+
     def forward(self, x: Union[OptTensor, Tuple[OptTensor, Tensor]],
                 edge_index: Adj, edge_type: OptTensor = None,
-                edge_attr: OptTensor = None):
+                edge_weight: OptTensor = None, slots=None):
 
         # Convert input features to a pair of node features or node indices.
         x_l: OptTensor = None
@@ -98,17 +122,35 @@ class GCL(RGCNConv):
                 h = torch.einsum('abc,bcd->abd', h, weight[i])
                 out += h.contiguous().view(-1, self.out_channels)
 
+        elif isinstance(edge_index, Tensor) and x_l.dtype != torch.long:
+            # No regularization/Basis-decomposition
+            # Messages of all the relations are aggregated in a single pass
+            # into (relation, destination node) slots, which are grouped by
+            # relation. The weights of each relation are then applied to its
+            # contiguous segment of slots.
+            if slots is None:
+                slots = typed_slots(edge_index, edge_type, x_r.size(0),
+                                    self.num_relations)
+            edge_slots, slot_nodes, rel_ptr = slots
+
+            slot_index = torch.stack((edge_index[0], edge_slots))
+            h = self.propagate(slot_index, x=x_l, edge_weight=edge_weight,
+                               size=(size[0], slot_nodes.size(0)))
+            h = torch.cat([h[rel_ptr[i]:rel_ptr[i+1]] @ weight[i]
+                           for i in range(self.num_relations)])
+            out = out.index_add(0, slot_nodes, h.to(out.dtype))
+
         else:
             # No regularization/Basis-decomposition
             for i in range(self.num_relations):
                 tmp = masked_edge_index(edge_index, edge_type == i)
-                attr = masked_edge_attrs(edge_attr, edge_type == i)
+                attr = masked_edge_attrs(edge_weight, edge_type == i)
 
                 if x_l.dtype == torch.long:
                     out += self.propagate(tmp, x=weight[i, x_l], size=size)
                 else:
                     h = self.propagate(tmp, x=x_l, size=size,
-                                       edge_attr=attr)
+                                       edge_weight=attr)
                     out = out + (h @ weight[i])
 
         root = self.root
@@ -120,12 +162,11 @@ class GCL(RGCNConv):
 
         return out
 
-    def message(self, x_j: Tensor, edge_attr: Tensor) -> Tensor:
+    def message(self, x_j: Tensor, edge_weight: Tensor) -> Tensor:
 
-        # Use edge nn to compute weight tensor from edge attributes
-        # (=onehot timestep distances between nodes)
-        weights = self.nn(edge_attr)
-        weights = weights[..., :self.in_channels_l]
+        # Edge weights have been computed by edge nn from edge attributes
+        # (see dist_weights)
+        weights = edge_weight[..., :self.in_channels_l]
         weights = weights.view(-1, self.in_channels_l)
 
         out = x_j * weights
@@ -173,6 +214,7 @@ class GCN(nn.Module):
         self.layers = nn.ModuleList()
         self.norm_layers = nn.ModuleList()
         edge_nn = nn.Linear(num_dists, input_dim)
+        self.num_dists = num_dists
         self.batch_norm = batch_norm
 
         self.layers.append(GCL(input_dim, hidden_dim, num_relations, edge_nn))
@@ -189,15 +231,25 @@ class GCN(nn.Module):
 
     def forward(self, data):
 
-        x, edge_index, edge_attrs = data.x, data.edge_index, data.edge_attrs
-        edge_type = edge_attrs[:, 0]
-        edge_attr = edge_attrs[:, 1:]
+        x, edge_index = data.x, data.edge_index
+        edge_type = data.edge_type.long()
+
+        # All the layers share the same edge nn, so the weights of each
+        # timestep distance are computed once per forward and gathered for
+        # each edge
+        dist_weights = self.layers[0].dist_weights(self.num_dists)
+        edge_weight = dist_weights[data.edge_dist.long()]
+
+        # Relation slots only depend on the graph and are shared by all the
+        # layers
+        slots = typed_slots(edge_index, edge_type, x.size(0),
+                            self.layers[0].num_relations)
 
         for i in range(len(self.layers)):
 
             residual = x
             x = F.dropout(x, p=self.p, training=self.training)
-            x = self.layers[i](x, edge_index, edge_type, edge_attr)
+            x = self.layers[i](x, edge_index, edge_type, edge_weight, slots)
 
             if self.batch_norm:
                 x = self.norm_layers[i](x)
@@ -309,10 +361,11 @@ class ContentEncoder(nn.Module):
 
         # Pitch and duration embedding layers (separate layers for drums
         # and non drums)
-        self.non_drums_pitch_emb = nn.Linear(constants.N_PITCH_TOKENS, 
-                                             self.d//2)
-        self.drums_pitch_emb = nn.Linear(constants.N_PITCH_TOKENS, self.d//2)
-        self.dur_emb = nn.Linear(constants.N_DUR_TOKENS, self.d//2)
+        self.non_drums_pitch_emb = nn.Embedding(constants.N_PITCH_TOKENS,
+                                                self.d//2)
+        self.drums_pitch_emb = nn.Embedding(constants.N_PITCH_TOKENS,
+                                            self.d//2)
+        self.dur_emb = nn.Embedding(constants.N_DUR_TOKENS, self.d//2)
 
         # Batch norm layers
         self.bn_non_drums = nn.BatchNorm1d(num_features=self.d//2)
@@ -341,8 +394,23 @@ class ContentEncoder(nn.Module):
 
         self.bars_encoder = nn.Linear(self.n_bars * self.d, self.d)
     
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+
+        # Older checkpoints store the embedding layers as nn.Linear layers
+        # applied to onehot tokens. Since a single input is set, each of them
+        # is equivalent to an embedding whose rows are the columns of the
+        # weight matrix plus the bias.
+        for name in ['non_drums_pitch_emb', 'drums_pitch_emb', 'dur_emb']:
+            bias = state_dict.pop(prefix + name + '.bias', None)
+            if bias is not None:
+                key = prefix + name + '.weight'
+                state_dict[key] = state_dict[key].t() + bias
+
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
     def forward(self, graph):
         
+        # Pitch and duration token ids (n_nodes x MAX_SIMU_TOKENS x 2)
         c_tensor = graph.c_tensor
 
         # Discard SOS token
@@ -354,11 +422,10 @@ class ContentEncoder(nn.Module):
 
         # Compute drums embeddings
         sz = drums.size()
-        drums_pitch = self.drums_pitch_emb(
-            drums[..., :constants.N_PITCH_TOKENS])
+        drums_pitch = self.drums_pitch_emb(drums[..., 0])
         drums_pitch = self.bn_drums(drums_pitch.view(-1, self.d//2))
         drums_pitch = drums_pitch.view(sz[0], sz[1], self.d//2)
-        drums_dur = self.dur_emb(drums[..., constants.N_PITCH_TOKENS:])
+        drums_dur = self.dur_emb(drums[..., 1])
         drums_dur = self.bn_dur(drums_dur.view(-1, self.d//2))
         drums_dur = drums_dur.view(sz[0], sz[1], self.d//2)
         drums = torch.cat((drums_pitch, drums_dur), dim=-1)
@@ -366,12 +433,10 @@ class ContentEncoder(nn.Module):
 
         # Compute non drums embeddings
         sz = non_drums.size()
-        non_drums_pitch = self.non_drums_pitch_emb(
-            non_drums[..., :constants.N_PITCH_TOKENS]
-        )
+        non_drums_pitch = self.non_drums_pitch_emb(non_drums[..., 0])
         non_drums_pitch = self.bn_non_drums(non_drums_pitch.view(-1, self.d//2))
         non_drums_pitch = non_drums_pitch.view(sz[0], sz[1], self.d//2)
-        non_drums_dur = self.dur_emb(non_drums[..., constants.N_PITCH_TOKENS:])
+        non_drums_dur = self.dur_emb(non_drums[..., 1])
         non_drums_dur = self.bn_dur(non_drums_dur.view(-1, self.d//2))
         non_drums_dur = non_drums_dur.view(sz[0], sz[1], self.d//2)
         non_drums = torch.cat((non_drums_pitch, non_drums_dur), dim=-1)
@@ -593,41 +658,44 @@ class Decoder(nn.Module):
 
         self.sigmoid_thresh = 0.5
 
-    def _structure_from_binary(self, s_tensor):
+        # Cache of bar graphs used when building structures from binary
+        # tensors (e.g. repeated structures in conditioned generation)
+        self.graph_cache = BarGraphCache()
 
-        # Create graph structures for each batch
-        s = []
-        for i in range(s_tensor.size(0)):
-            s.append(graph_from_tensor(s_tensor[i]))
+    def _structure_from_packed(self, s_words, n_timesteps):
 
-        # Create batch of graphs from single graphs
-        s = Batch.from_data_list(s, exclude_keys=['batch'])
-        s = s.to(next(self.parameters()).device)
+        # Create the batch of graph structures directly on the model's device,
+        # starting from a packed structure tensor
+        s_words = s_words.to(next(self.parameters()).device)
+        s = batch_from_packed(s_words, n_timesteps, self.graph_cache)
 
         return s
 
-    def _binary_from_logits(self, s_logits):
+    def _packed_from_logits(self, s_logits):
 
         # Hard threshold instead of sampling gives more pleasant results
-        s_tensor = torch.sigmoid(s_logits)
-        s_tensor[s_tensor >= self.sigmoid_thresh] = 1
-        s_tensor[s_tensor < self.sigmoid_thresh] = 0
-        s_tensor = s_tensor.bool()
-        
+        s_tensor = torch.sigmoid(s_logits) >= self.sigmoid_thresh
+        s_words = pack_structure(s_tensor)
+
         # Avoid empty bars by creating a fake activation for each empty
-        # (n_tracks x n_timesteps) bar matrix in position [0, 0]
-        empty_mask = ~s_tensor.any(dim=-1).any(dim=-1)
-        idxs = torch.nonzero(empty_mask, as_tuple=True)
-        s_tensor[idxs + (0, 0)] = True
+        # bar in position [0, 0] (first timestep of the first track)
+        empty_mask = or_tracks(s_words) == 0
+        s_words[..., 0] |= empty_mask.long()
+
+        return s_words
+
+    def _binary_from_logits(self, s_logits):
+
+        s_words = self._packed_from_logits(s_logits)
 
-        return s_tensor
+        return unpack_structure(s_words, s_logits.size(-1))
 
     def _structure_from_logits(self, s_logits):
 
-        # Compute binary structure tensor from logits and build torch geometric
-        # structure from binary tensor
-        s_tensor = self._binary_from_logits(s_logits)
-        s = self._structure_from_binary(s_tensor)
+        # Compute packed structure tensor from logits and build torch geometric
+        # structure from it
+        s_words = self._packed_from_logits(s_logits)
+        s = self._structure_from_packed(s_words, s_logits.size(-1))
 
         return s
 
@@ -0,0 +1,104 @@
+import numpy as np
+import torch
+
+
+# Binary structure tensors are packed along the timestep axis: the activations
+# of a track in a bar are stored in a single 32-bit word, where bit t is set if
+# the track is active in timestep t. Packed structures are stored as uint32
+# numpy arrays and handled as int64 torch tensors (torch has no uint32 type).
+# An (n_bars x n_tracks x n_timesteps) structure tensor becomes an
+# (n_bars x n_tracks) tensor of words.
+MAX_PACKED_TIMESTEPS = 32
+
+
+def _check_n_timesteps(n_timesteps):
+    if n_timesteps > MAX_PACKED_TIMESTEPS:
+        raise ValueError(f"Packed structures support at most "
+                         f"{MAX_PACKED_TIMESTEPS} timesteps per bar, "
+                         f"got {n_timesteps}")
+
+
+def pack_structure_np(s_tensor):
+
+    # s_tensor: ... x n_timesteps boolean array
+    n_timesteps = s_tensor.shape[-1]
+    _check_n_timesteps(n_timesteps)
+
+    bits = np.zeros(s_tensor.shape[:-1] + (MAX_PACKED_TIMESTEPS,), dtype=bool)
+    bits[..., :n_timesteps] = s_tensor
+    packed = np.packbits(bits, axis=-1, bitorder='little')
+
+    return packed.view('<u4')[..., 0].astype(np.uint32)
+
+
+def unpack_structure_np(words, n_timesteps):
+
+    _check_n_timesteps(n_timesteps)
+
+    words = np.ascontiguousarray(words, dtype='<u4')
+    packed = words.view(np.uint8).reshape(words.shape + (4,))
+    bits = np.unpackbits(packed, axis=-1, bitorder='little')
+
+    return bits[..., :n_timesteps].astype(bool)
+
+
+def pack_structure(s_tensor):
+
+    # s_tensor: ... x n_timesteps tensor
+    n_timesteps = s_tensor.size(-1)
+    _check_n_timesteps(n_timesteps)
+
+    shifts = torch.arange(n_timesteps, device=s_tensor.device)
+    words = s_tensor.bool().long() << shifts
+
+    return words.sum(dim=-1)
+
+
+def unpack_structure(words, n_timesteps):
+
+    _check_n_timesteps(n_timesteps)
+
+    shifts = torch.arange(n_timesteps, device=words.device)
+
+    return ((words.unsqueeze(-1) >> shifts) & 1).bool()
+
+
+def popcount(words):
+
+    # Number of set bits in each (32-bit) word
+    words = words - ((words >> 1) & 0x55555555)
+    words = (words & 0x33333333) + ((words >> 2) & 0x33333333)
+    words = (words + (words >> 4)) & 0x0F0F0F0F
+
+    return ((words * 0x01010101) >> 24) & 0xFF
+
+
+def next_set_bit(words, pos):
+
+    # Index of the first set bit in position >= pos for each word (-1 if
+    # there are no such bits)
+    pos = torch.as_tensor(pos, device=words.device)
+    masked = words & ~((torch.ones_like(pos) << pos) - 1)
+    lowest = masked & -masked
+
+    return torch.where(masked != 0, popcount(lowest - 1),
+                       torch.full_like(masked, -1))
+
+
+def or_tracks(words):
+
+    # Timesteps where at least one track is active
+    # words: ... x n_tracks
+    out = words[..., 0]
+    for track in range(1, words.size(-1)):
+        out = out | words[..., track]
+
+    return out
+
+
+def and_tracks(words, pairs):
+
+    # Timesteps where both tracks of each pair are active
+    # words: ... x n_tracks, pairs: n_pairs x 2
+    # Output: ... x n_pairs
+    return words[..., pairs[:, 0]] & words[..., pairs[:, 1]]
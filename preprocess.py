@@ -1,63 +1,158 @@
 import os
 import time
 import sys
+import json
+import zlib
 import multiprocessing
 import itertools
 import argparse
+from collections import defaultdict
+from functools import partial
 from itertools import product
 
 import numpy as np
+import torch
 import tqdm
+import pretty_midi
 import pypianoroll as pproll
-import muspy
 
 import constants
 from constants import PitchToken, DurationToken
+from packing import pack_structure_np, MAX_PACKED_TIMESTEPS
+from shards import SongShardWriter, is_sharded
+from data import graph_edges
 
 
-def preprocess_midi_file(filepath, dest_dir, n_bars, resolution):
+JOURNAL_FILENAME = 'journal.jsonl'
 
+
+def pianoroll_notes(pianoroll):
+
+    # (n_notes x 3) array with the onset, pitch and duration of the notes of
+    # a (n_timesteps x 128) piano roll, sorted by onset and pitch. Notes are
+    # the runs of consecutive active timesteps of each pitch (as in
+    # muspy.from_pypianoroll_track).
+    active = pianoroll > 0
+    diff = np.diff(active.astype(np.int8), axis=0, prepend=0, append=0)
+
+    # Note boundaries of each pitch, ordered by time. Every pitch has an even
+    # number of boundaries, which alternate between onsets and offsets.
+    pitches, times = np.nonzero(diff.T)
+    onsets, offsets = times[0::2], times[1::2]
+    pitches = pitches[0::2]
+
+    order = np.lexsort((pitches, onsets))
+    notes = np.stack([onsets[order], pitches[order],
+                      (offsets - onsets)[order]], axis=1)
+
+    return notes.astype(np.int64).reshape(-1, 3)
+
+
+def padded_length(end, resolution):
+
+    # Number of timesteps of a subsong whose notes end by timestep end: the
+    # subsong also includes timestep end, and timesteps are added until its
+    # length is a multiple of the number of timesteps of a bar
+    length = end + 1
+
+    return length if length % (4*resolution) == 0 \
+        else length + (4*resolution-(length % (4*resolution)))
+
+
+def tokenize_notes(times, pitches, durations, length):
+
+    # Builds the content tensor (length x MAX_SIMU_TOKENS x 2) and the
+    # activations (length) of a track from the onsets, pitches and durations
+    # of its notes. The last dimension of the content tensor contains pitches
+    # and durations. int16 is enough to encode small to medium duration
+    # values. Each timestep holds an SOS token, its notes in order of
+    # appearance (at most MAX_SIMU_TOKENS-2, further notes are skipped), an EOS
+    # token and PAD tokens.
+    content = np.zeros((length, constants.MAX_SIMU_TOKENS, 2), np.int16)
+    content[:, :, 0] = PitchToken.PAD.value
+    content[:, 0, 0] = PitchToken.SOS.value
+    content[:, :, 1] = DurationToken.PAD.value
+    content[:, 0, 1] = DurationToken.SOS.value
+
+    # Position of each note among the notes of its timestep (the sort is
+    # stable, so notes keep their order within a timestep)
+    order = np.argsort(times, kind='stable')
+    times = times[order]
+    ranks = np.arange(len(times)) - np.searchsorted(times, times, side='left')
+
+    # Skip notes if there is no more space
+    kept = ranks < constants.MAX_SIMU_TOKENS - 2
+    times, ranks, order = times[kept], ranks[kept], order[kept]
+
+    # Insert notes after the SOS token
+    pitches = np.clip(pitches[order], 0, constants.MAX_PITCH_TOKEN)
+    durations = np.clip(durations[order], 1, constants.MAX_DUR_TOKEN + 1)
+    content[times, ranks + 1, 0] = pitches
+    content[times, ranks + 1, 1] = durations - 1
+
+    # Add EOS token
+    n_notes = np.bincount(times, minlength=length)
+    content[np.arange(length), n_notes + 1, 0] = PitchToken.EOS.value
+    content[np.arange(length), n_notes + 1, 1] = DurationToken.EOS.value
+
+    # Get track activations, a boolean tensor indicating whether notes are
+    # being played in a timestep (sustain does not count)
+    # (needed for graph rep.)
+    activations = n_notes > 0
+
+    return content, activations
+
+
+def preprocess_midi_file(filepath, resolution, precompute_graphs=False,
+                         transpose=False):
+
+    # Returns the list of (content, structure, info, edges) subsongs
+    # extracted from the file and the reason why the file was skipped (None
+    # if it was not), where info contains the subsong metadata
+    # stored in the dataset song table and edges is the edge list of the bar
+    # graphs (None if precompute_graphs is False). Subsongs are stored whole:
+    # samples of any number of bars are cut from them when the dataset is
+    # loaded. If transpose is True, each subsong is randomly transposed once
+    # and for all (otherwise, transpositions can be applied during training,
+    # see data.RandomTranspose). Subsongs are written to disk by the main
+    # process.
     print("Preprocessing file {}".format(filepath))
 
-    filename = os.path.basename(filepath)
-    saved_samples = 0
+    samples = []
 
-    # Load the file both as a pypianoroll song and a muspy song
-    # (Need to load both since muspy.to_pypianoroll() is expensive)
+    # Parse the file once. The time signature and track filters are applied
+    # to the parsed file, before its notes are quantized.
     try:
-        pproll_song = pproll.read(filepath, resolution=resolution)
-        muspy_song = muspy.read(filepath)
+        midi = pretty_midi.PrettyMIDI(filepath)
     except Exception as e:
         print("Song skipped (Invalid song format)")
-        return 0
+        return samples, 'invalid format'
 
     # Only accept songs that have a time signature of 4/4 and no time changes
-    for t in muspy_song.time_signatures:
+    for t in midi.time_signature_changes:
         if t.numerator != 4 or t.denominator != 4:
             print("Song skipped ({}/{} time signature)".
                   format(t.numerator, t.denominator))
-            return 0
+            return samples, 'time signature'
 
-    # Gather tracks of pypianoroll song based on MIDI program number
+    # Gather tracks based on MIDI program number (pypianoroll tracks follow
+    # the order of the instruments of the parsed file)
     drum_tracks = []
     bass_tracks = []
     guitar_tracks = []
     strings_tracks = []
 
-    for track in pproll_song.tracks:
-        if track.is_drum:
-            track.name = 'Drums'
-            drum_tracks.append(track)
-        elif 0 <= track.program <= 31:
-            track.name = 'Guitar'
-            guitar_tracks.append(track)
-        elif 32 <= track.program <= 39:
-            track.name = 'Bass'
-            bass_tracks.append(track)
+    for i, instrument in enumerate(midi.instruments):
+        if instrument.is_drum:
+            drum_tracks.append(i)
+        elif 0 <= instrument.program <= 31:
+            guitar_tracks.append(i)
+        elif 32 <= instrument.program <= 39:
+            bass_tracks.append(i)
         else:
             # Tracks with program > 39 are all considered as strings tracks
             # and will be merged into a single track later on
-            strings_tracks.append(track)
+            strings_tracks.append(i)
 
     # Filter song if it does not contain drum, guitar, bass or strings tracks
     # if not guitar_tracks \
@@ -65,171 +160,284 @@ def preprocess_midi_file(filepath, dest_dir, n_bars, resolution):
             or not bass_tracks or not strings_tracks:
         print("Song skipped (does not contain drum or "
               "guitar or bass or strings tracks)")
-        return 0
+        return samples, 'missing tracks'
 
-    # Merge strings tracks into a single pypianoroll track
-    strings = pproll.Multitrack(tracks=strings_tracks)
-    strings_track = pproll.Track(pianoroll=strings.blend(mode='max'),
-                                 program=48, name='Strings')
-
-    combinations = list(product(drum_tracks, bass_tracks, guitar_tracks))
+    # Quantize the notes of the song
+    try:
+        pproll_song = pproll.from_pretty_midi(midi, resolution=resolution)
+    except Exception as e:
+        print("Song skipped (Invalid song format)")
+        return samples, 'invalid format'
+
+    # Merge strings tracks into a single piano roll
+    pianorolls = [track.pianoroll for track in pproll_song.tracks]
+    strings_pianoroll = np.max([pianorolls[i] for i in strings_tracks],
+                               axis=0)
+
+    # Tokenize each track once: the content of a track does not depend on
+    # the combination it belongs to, so combinations are assembled from the
+    # content of their tracks. Tracks are tokenized over the length of the
+    # longest one and cut to the length of each combination.
+    roles = [[pianorolls[i] for i in tracks]
+             for tracks in (drum_tracks, bass_tracks, guitar_tracks)]
+    roles.append([strings_pianoroll])
+    roles_notes = [[pianoroll_notes(pianoroll) for pianoroll in pianorolls]
+                   for pianorolls in roles]
+    roles_ends = [[np.max(notes[:, 0] + notes[:, 2], initial=0)
+                   for notes in role_notes]
+                  for role_notes in roles_notes]
+    max_length = padded_length(max(max(ends) for ends in roles_ends),
+                               resolution)
+    roles_tokens = [[tokenize_notes(notes[:, 0], notes[:, 1], notes[:, 2],
+                                    max_length)
+                     for notes in role_notes]
+                    for role_notes in roles_notes]
+
+    combinations = list(product(range(len(drum_tracks)),
+                                range(len(bass_tracks)),
+                                range(len(guitar_tracks)), [0]))
 
     # Single instruments can have multiple tracks.
     # Consider all possible combinations of drum, bass, and guitar tracks
-    for i, combination in enumerate(combinations):
+    for subsong, combination in enumerate(combinations):
 
-        print("Processing combination {} of {}".format(i + 1, 
+        print("Processing combination {} of {}".format(subsong + 1, 
                                                        len(combinations)))
 
         # Process combination (called 'subsong' from now on)
-        drum_track, bass_track, guitar_track = combination
-        tracks = [drum_track, bass_track, guitar_track, strings_track]
-
-        pproll_subsong = pproll.Multitrack(
-            tracks=tracks,
-            tempo=pproll_song.tempo,
-            resolution=resolution
-        )
-        muspy_subsong = muspy.from_pypianoroll(pproll_subsong)
-
-        tracks_notes = [track.notes for track in muspy_subsong.tracks]
+        tokens = [roles_tokens[role][i] for role, i in enumerate(combination)]
 
         # Obtain length of subsong (maximum of each track's length)
-        length = 0
-        for notes in tracks_notes:
-            track_length = max(note.end for note in notes) if notes else 0
-            length = max(length, track_length)
-        length += 1
-
-        # Add timesteps until length is a multiple of resolution
-        length = length if length % (4*resolution) == 0 \
-            else length + (4*resolution-(length % (4*resolution)))
-
-        tracks_content = []
-        tracks_structure = []
-
-        for notes in tracks_notes:
-
-            # track_content: length x MAX_SIMU_TOKENS x 2
-            # This is used as a basis to build the final content tensors for
-            # each sequence.
-            # The last dimension contains pitches and durations. int16 is enough
-            # to encode small to medium duration values.
-            track_content = np.zeros((length, constants.MAX_SIMU_TOKENS, 2), 
-                                    np.int16)
-
-            track_content[:, :, 0] = PitchToken.PAD.value
-            track_content[:, 0, 0] = PitchToken.SOS.value
-            track_content[:, :, 1] = DurationToken.PAD.value
-            track_content[:, 0, 1] = DurationToken.SOS.value
-
-            # Keeps track of how many notes have been stored in each timestep
-            # (int8 imposes MAX_SIMU_TOKENS < 256)
-            notes_counter = np.ones(length, dtype=np.int8)
-
-            # Todo: np.put_along_axis?
-            for note in notes:
-                # Insert note in the lowest position available in the timestep
-
-                t = note.time
-
-                if notes_counter[t] >= constants.MAX_SIMU_TOKENS-1:
-                    # Skip note if there is no more space
-                    continue
-
-                pitch = max(min(note.pitch, constants.MAX_PITCH_TOKEN), 0)
-                track_content[t, notes_counter[t], 0] = pitch
-                dur = max(min(note.duration, constants.MAX_DUR_TOKEN + 1), 1)
-                track_content[t, notes_counter[t], 1] = dur-1
-                notes_counter[t] += 1
-
-            # Add EOS token
-            t_range = np.arange(0, length)
-            track_content[t_range, notes_counter, 0] = PitchToken.EOS.value
-            track_content[t_range, notes_counter, 1] = DurationToken.EOS.value
-
-            # Get track activations, a boolean tensor indicating whether notes
-            # are being played in a timestep (sustain does not count)
-            # (needed for graph rep.)
-            activations = np.array(notes_counter-1, dtype=bool)
-
-            tracks_content.append(track_content)
-            tracks_structure.append(activations)
-
-        # n_tracks x length x MAX_SIMU_TOKENS x 2
-        subsong_content = np.stack(tracks_content, axis=0)
-
-        # n_tracks x length
-        subsong_structure = np.stack(tracks_structure, axis=0)
-
-        # Slide window over 'subsong_content' and 'subsong_structure' along the
-        # time axis (2nd dimension) with the stride of a bar
-        # Todo: np.lib.stride_tricks.as_strided(song_proll)?
-        for i in range(0, length-n_bars*4*resolution+1, 4*resolution):
-
-            # Get the content and structure tensors of a single sequence
-            c_tensor = subsong_content[:, i:i+n_bars*4*resolution, :]
-            s_tensor = subsong_structure[:, i:i+n_bars*4*resolution]
-            c_tensor = np.copy(c_tensor)
-            s_tensor = np.copy(s_tensor)
-
-            if n_bars > 1:
-                # Skip sequence if it contains more than one bar of consecutive
-                # silence in at least one track
-                bars = s_tensor.reshape(s_tensor.shape[0], n_bars, -1)
-                bars_acts = np.any(bars, axis=2)
-
-                if 1 in np.diff(np.where(bars_acts == 0)[1]):
-                    continue
-
-                # Skip sequence if it contains one bar of complete silence
-                silences = np.logical_not(np.any(bars_acts, axis=0))
-                if np.any(silences):
-                    continue
-
-            else:
-                # Skip if all tracks are silenced
-                bar_acts = np.any(s_tensor, axis=1)
-                if not np.any(bar_acts):
-                    continue
-
-            # Randomly transpose the pitches of the sequence (-5 to 6 semitones)
-            # Not considering SOS, EOS or PAD tokens. Not transposing drums.
+        length = padded_length(max(roles_ends[role][i] for role, i
+                                   in enumerate(combination)), resolution)
+
+        n_song_bars = length // (4*resolution)
+
+        def bar_major(tensor):
+            # View of the first length timesteps of a track tensor as
+            # (n_bars x n_timesteps x ...)
+            return tensor[:length].reshape(n_song_bars, 4*resolution,
+                                           *tensor.shape[1:])
+
+        # n_bars x n_tracks x n_timesteps
+        bars = np.stack([bar_major(activations)
+                         for _, activations in tokens], axis=1)
+
+        # Skip subsong if all tracks are silenced
+        if not np.any(bars):
+            continue
+
+        # n_bars x n_tracks x n_timesteps x MAX_SIMU_TOKENS x 2, gathered
+        # from the track contents in a single copy
+        c_tensor = np.stack([bar_major(content) for content, _ in tokens],
+                            axis=1)
+
+        if transpose:
+            # Randomly transpose the pitches of the subsong (-5 to 6
+            # semitones). Not considering SOS, EOS or PAD tokens. Not
+            # transposing drums.
             shift = np.random.choice(np.arange(-5, 7), 1)
-            cond = (c_tensor[1:, :, :, 0] != PitchToken.PAD.value) &           \
-                   (c_tensor[1:, :, :, 0] != PitchToken.SOS.value) &           \
-                   (c_tensor[1:, :, :, 0] != PitchToken.EOS.value)
-            non_drums = c_tensor[1:, ...]
+            cond = (c_tensor[:, 1:, :, :, 0] != PitchToken.PAD.value) &      \
+                   (c_tensor[:, 1:, :, :, 0] != PitchToken.SOS.value) &      \
+                   (c_tensor[:, 1:, :, :, 0] != PitchToken.EOS.value)
+            non_drums = c_tensor[:, 1:, ...]
             non_drums[cond, 0] += shift
-            non_drums[cond, 0] = np.clip(non_drums[cond, 0], a_min=0, 
+            non_drums[cond, 0] = np.clip(non_drums[cond, 0], a_min=0,
                                          a_max=constants.MAX_PITCH_TOKEN)
 
-            # Save sample (content and structure) to file
-            sample_filepath = os.path.join(
-                dest_dir, filename+str(saved_samples))
-            np.savez(sample_filepath, c_tensor=c_tensor, s_tensor=s_tensor)
+        # Pack the structure tensor into one word per bar-track
+        # (n_bars x n_tracks)
+        s_tensor = pack_structure_np(bars)
 
-            saved_samples += 1
+        # Edges of the graph of each bar, with node labels local to the bar.
+        # Bar graphs are disconnected, so the graph of any window of bars
+        # can be assembled from them.
+        n_nodes, edges = graph_edges(torch.from_numpy(bars))
+        edges = edges.numpy()
+        bar_n_nodes = np.maximum(bars.sum(axis=(1, 2)), 1)
+        first_nodes = np.cumsum(bar_n_nodes) - bar_n_nodes
+        edge_bars = np.searchsorted(first_nodes, edges[:, 0],
+                                    side='right') - 1
+        order = np.argsort(edge_bars, kind='stable')
+        edges, edge_bars = edges[order], edge_bars[order]
+        edges[:, :2] -= first_nodes[edge_bars][:, None]
 
-
-def preprocess_midi_dataset(midi_dataset_dir, preprocessed_dir, n_bars, 
-                            resolution, n_files=None, n_workers=1):
+        info = {
+            'source': filepath,
+            'subsong': subsong,
+            'bar_n_edges': np.bincount(edge_bars, minlength=n_song_bars)
+        }
+        edges = edges if precompute_graphs else None
+
+        samples.append((c_tensor, s_tensor, info, edges))
+
+    return samples, None
+
+
+class Journal():
+
+    # Persistent record of the files processed by a preprocessing run, stored
+    # as one JSON line per file with its skip reason ('ok' if it was not
+    # skipped), its number of subsongs and the shard flush that made it
+    # final. Records are written right before the flush of the dataset index
+    # (see SongShardWriter), so records of a flush that did not complete are
+    # discarded when the journal is loaded.
+    def __init__(self, dir):
+        self.path = os.path.join(dir, JOURNAL_FILENAME)
+        self.pending = []
+
+    def load(self, n_shards):
+
+        # Files whose subsongs are in the first n_shards shards. The journal
+        # is rewritten with their records only, since the discarded records
+        # would otherwise refer to the shards written after resuming. It is
+        # replaced atomically, as the dataset index.
+        records = []
+        if os.path.exists(self.path):
+            with open(self.path, 'r') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # Truncated last line
+                        continue
+                    if record['shard'] < n_shards:
+                        records.append(record)
+
+        with open(self.path + '.tmp', 'w') as f:
+            for record in records:
+                f.write(json.dumps(record) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(self.path + '.tmp', self.path)
+
+        return set(record['file'] for record in records)
+
+    def reset(self):
+
+        # Empty journal, for a new dataset
+        open(self.path, 'w').close()
+
+    def add(self, file, reason, n_subsongs):
+        self.pending.append({'file': file, 'status': reason or 'ok',
+                             'subsongs': n_subsongs})
+
+    def commit(self, shard):
+
+        with open(self.path, 'a') as f:
+            for record in self.pending:
+                f.write(json.dumps(dict(record, shard=shard)) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+        self.pending = []
+
+
+def file_seed(file, seed=0):
+
+    # Random seed of a file, which only depends on its path (relative to the
+    # dataset directory) and on the seed of the run, so that random
+    # transpositions do not depend on the order in which files are processed
+    return (zlib.crc32(file.encode()) ^ seed) & 0xFFFFFFFF
+
+
+def _preprocess_task(filepath, midi_dataset_dir, seed, **kwargs):
+
+    file = os.path.relpath(filepath, midi_dataset_dir)
+    np.random.seed(file_seed(file, seed))
+    samples, reason = preprocess_midi_file(filepath, **kwargs)
+
+    return file, samples, reason
+
+
+def preprocess_midi_dataset(midi_dataset_dir, preprocessed_dir, resolution,
+                            n_files=None, n_workers=1, shard_size=65536,
+                            precompute_graphs=False, transpose=False,
+                            resume=False, seed=0, compress=False,
+                            chunksize=4):
+
+    if 4 * resolution > MAX_PACKED_TIMESTEPS:
+        raise ValueError(f"Resolution {resolution} is too high: structure "
+                         f"tensors support at most {MAX_PACKED_TIMESTEPS} "
+                         f"timesteps per bar")
+
+    # Files already processed by a previous (interrupted) run are skipped
+    journal = Journal(preprocessed_dir)
+    if is_sharded(preprocessed_dir):
+        if not resume:
+            raise ValueError(f"{preprocessed_dir} already contains a "
+                             f"preprocessed dataset (use resume to complete "
+                             f"it)")
+        writer = SongShardWriter.resume(preprocessed_dir, shard_size)
+        graphs = writer.meta.get('graphs', False)
+        if (writer.meta['resolution'] != resolution or
+                writer.meta.get('transposed', False) != transpose or
+                writer.compress != compress or
+                (writer.shard_lens and graphs != precompute_graphs)):
+            raise ValueError("The preprocessing parameters do not match "
+                             "the ones of the dataset to be resumed")
+        done = journal.load(len(writer.shard_lens))
+        print("Resuming preprocessing ({} files already processed)"
+              .format(len(done)))
+    else:
+        writer = SongShardWriter(preprocessed_dir, shard_size, compress,
+                                 resolution=resolution, transposed=transpose)
+        journal.reset()
+        done = set()
 
     print("Starting preprocessing")
     start = time.time()
 
     # Visit recursively the directories inside the dataset directory
-    with multiprocessing.Pool(n_workers) as pool:
-
-        walk = os.walk(midi_dataset_dir)
-        fn_gen = itertools.chain.from_iterable(
-            ((os.path.join(dirpath, file), preprocessed_dir, n_bars, resolution)
-                for file in files)
-                for dirpath, dirs, files in walk
-        )
-
-        r = list(tqdm.tqdm(pool.starmap(preprocess_midi_file, fn_gen),
-                           total=n_files))
+    walk = os.walk(midi_dataset_dir)
+    fn_gen = itertools.chain.from_iterable(
+        (os.path.join(dirpath, file) for file in files)
+            for dirpath, dirs, files in walk
+    )
+    fn_gen = (fn for fn in fn_gen
+              if os.path.relpath(fn, midi_dataset_dir) not in done)
+    preprocess_fn = partial(_preprocess_task,
+                            midi_dataset_dir=midi_dataset_dir, seed=seed,
+                            resolution=resolution,
+                            precompute_graphs=precompute_graphs,
+                            transpose=transpose)
+
+    # Files are processed by the workers in any order, while subsongs are
+    # written to the dataset shards by the main process as soon as each file
+    # is done. Files are recorded in the journal when their shard is flushed.
+    skipped = defaultdict(int)
+    n_bars = 0
+    total = n_files - len(done) if n_files is not None else None
+    with multiprocessing.Pool(n_workers) as pool, \
+            tqdm.tqdm(total=total) as progress_bar:
+
+        results = pool.imap_unordered(preprocess_fn, fn_gen, chunksize)
+        for file, samples, reason in results:
+            for c_tensor, s_tensor, info, edges in samples:
+                info['source'] = file
+                writer.add(c_tensor, s_tensor, info, edges)
+                n_bars += len(c_tensor)
+            journal.add(file, reason, len(samples))
+
+            if writer.is_full():
+                journal.commit(len(writer.shard_lens))
+                writer.flush()
+
+            # Throughput
+            if reason is not None:
+                skipped[reason] += 1
+            elapsed = time.time() - start
+            progress_bar.set_postfix(bars_per_s=round(n_bars / elapsed),
+                                     skipped=sum(skipped.values()))
+            progress_bar.update(1)
+
+        # Records of files with no buffered subsongs are already final
+        journal.commit(len(writer.shard_lens) - (writer.n_buffered == 0))
+        writer.close()
+
+    print("Saved {} subsongs ({} bars) in {} shards".format(
+        len(writer), sum(writer.shard_lens), len(writer.shard_lens)))
+    print("Skipped files: {}".format(dict(skipped)))
 
     end = time.time()
     hours, rem = divmod(end-start, 3600)
@@ -255,20 +463,13 @@ if __name__ == "__main__":
         type=str,
         help='Directory to save the preprocessed dataset.'
     )
-    parser.add_argument(
-        '--n_bars',
-        type=int,
-        default=2,
-        help="Number of bars for each sequence of the resulting preprocessed "
-            "dataset. Defaults to 2 bars."
-    )
     parser.add_argument(
         '--resolution',
         type=int,
         default=8,
         help="Number of timesteps per beat. When set to r, given that only "
             "4/4 songs are preprocessed, there will be 4*r timesteps in a bar. "
-            "Defaults to 8."
+            "Must be at most 8 (32 timesteps per bar). Defaults to 8."
     )
     parser.add_argument(
         '--n_files',
@@ -282,6 +483,62 @@ if __name__ == "__main__":
         default=1,
         help="Number of parallel workers. Defaults to 1."
     )
+    parser.add_argument(
+        '--shard_size',
+        type=int,
+        default=65536,
+        help="Minimum number of bars stored in each shard of the preprocessed "
+            "dataset (subsongs are not split across shards). "
+            "Defaults to 65536."
+    )
+
+    parser.add_argument(
+        '--precompute_graphs',
+        action='store_true',
+        default=False,
+        help="Flag to store the edges of the graph of each bar in the "
+            "preprocessed dataset, so that they do not have to be computed "
+            "during training."
+    )
+
+    parser.add_argument(
+        '--transpose',
+        action='store_true',
+        default=False,
+        help="Flag to randomly transpose each subsong (from -5 to +6 "
+            "semitones) when it is preprocessed, as done by previous versions "
+            "of the script. By default, subsongs are stored untransposed and "
+            "can be transposed during training with the --transpose flag of "
+            "train.py."
+    )
+
+    parser.add_argument(
+        '--compress',
+        action='store_true',
+        default=False,
+        help="Flag to compress the notes stored in the preprocessed dataset "
+            "(with zlib, in blocks of bars that are decompressed when read). "
+            "Reduces the size of the dataset at the cost of some decoding "
+            "time."
+    )
+
+    parser.add_argument(
+        '--resume',
+        action='store_true',
+        default=False,
+        help="Flag to resume an interrupted preprocessing run on the same "
+            "preprocessed directory. Files processed by the previous run are "
+            "read from its journal and skipped."
+    )
+
+    parser.add_argument(
+        '--seed',
+        type=int,
+        default=0,
+        help="Seed of the random transpositions. The transposition of each "
+            "file only depends on the seed and on the path of the file. "
+            "Defaults to 0."
+    )
 
     args = parser.parse_args()
     
@@ -289,6 +546,12 @@ if __name__ == "__main__":
     if not os.path.exists(args.preprocessed_dir):
         os.makedirs(args.preprocessed_dir)
 
-    preprocess_midi_dataset(args.midi_dataset_dir, args.preprocessed_dir, 
-                            args.n_bars, args.resolution, args.n_files,
-                            n_workers=args.n_workers)
+    preprocess_midi_dataset(args.midi_dataset_dir, args.preprocessed_dir,
+                            args.resolution, args.n_files,
+                            n_workers=args.n_workers,
+                            shard_size=args.shard_size,
+                            precompute_graphs=args.precompute_graphs,
+                            transpose=args.transpose,
+                            resume=args.resume,
+                            seed=args.seed,
+                            compress=args.compress)
@@ -0,0 +1,579 @@
+import os
+import json
+import zlib
+from collections import OrderedDict
+
+import numpy as np
+
+import constants
+from constants import PitchToken, DurationToken
+from packing import unpack_structure_np, popcount
+
+
+# Preprocessed datasets are stored as a sequence of shards, which hold whole
+# subsongs: the rows of the shard arrays are bars, and the subsongs are
+# contiguous ranges of bars. Samples of any number of bars are cut from the
+# subsongs at load time (see SongShardReader.windows). The index file stores
+# the number of bars of each shard and the preprocessing parameters, while
+# the song table stores the metadata of each subsong (see SongTable).
+#
+# The structure tensor of each shard is stored packed in a .npy file, which
+# is read through a memory map. Optionally, shards also store the edge lists
+# of the bar graphs, with node labels local to each bar, concatenated in a
+# single array along with the offsets of the edges of each bar.
+#
+# Shards do not store the content tensor, which is mostly made of PAD tokens:
+# for each active (bar, track, timestep), in bar-major order, they store its
+# number of notes, and the (pitch, duration) tokens of the notes are
+# concatenated in a single uint8 array (see encode_notes). Optionally, the
+# note array is compressed with zlib in blocks of block_size bars, which are
+# decompressed on read.
+INDEX_FILENAME = 'index.json'
+SONGS_FILENAME = 'songs.npz'
+
+
+def structure_path(dir, shard):
+    return os.path.join(dir, 'structure_{:05d}.npy'.format(shard))
+
+
+def edges_path(dir, shard):
+    return os.path.join(dir, 'edges_{:05d}.npy'.format(shard))
+
+
+def edge_ptr_path(dir, shard):
+    return os.path.join(dir, 'edge_ptr_{:05d}.npy'.format(shard))
+
+
+def n_notes_path(dir, shard):
+    return os.path.join(dir, 'n_notes_{:05d}.npy'.format(shard))
+
+
+def notes_path(dir, shard):
+    return os.path.join(dir, 'notes_{:05d}.npy'.format(shard))
+
+
+def block_ptr_path(dir, shard):
+    return os.path.join(dir, 'block_ptr_{:05d}.npy'.format(shard))
+
+
+def is_sharded(dir):
+    return os.path.exists(os.path.join(dir, INDEX_FILENAME))
+
+
+def read_index(dir):
+    with open(os.path.join(dir, INDEX_FILENAME), 'r') as f:
+        return json.load(f)
+
+
+def is_song_dataset(dir):
+    return is_sharded(dir) and read_index(dir).get('layout') == 'songs'
+
+
+def window_mask(acts, n_bars):
+
+    # acts: n_bars_tot x n_tracks boolean array, where acts[b, t] is True if
+    # track t is active in bar b. Returns a boolean mask over the
+    # n_bars_tot - n_bars + 1 windows of n_bars bars, which is False for the
+    # windows discarded by the silence filters of preprocessing.
+    n_windows = len(acts) - n_bars + 1
+    if n_windows <= 0:
+        return np.zeros(0, dtype=bool)
+
+    # n_windows x n_tracks x n_bars view of the silent bars of each window
+    silent = np.ascontiguousarray(~acts)
+    stride_bar, stride_track = silent.strides
+    windows = np.lib.stride_tricks.as_strided(
+        silent, (n_windows, silent.shape[1], n_bars),
+        (stride_bar, stride_track, stride_bar))
+
+    if n_bars == 1:
+        # Skip if all tracks are silenced
+        return ~np.all(windows[..., 0], axis=1)
+
+    # Skip windows that contain one bar of complete silence
+    mask = ~np.any(np.all(windows, axis=1), axis=1)
+
+    # Skip windows that contain more than one bar of consecutive silence in
+    # at least one track. As in previous versions, silent bars are compared
+    # in (track, bar) order, so the last silent bar of a track and the first
+    # silent bar of the next track with silences also count as consecutive.
+    mask &= ~np.any(windows[..., :-1] & windows[..., 1:], axis=(1, 2))
+    has_silence = np.any(windows, axis=2)
+    first = np.argmax(windows, axis=2)
+    last = n_bars - 1 - np.argmax(windows[..., ::-1], axis=2)
+    prev_last = np.full(n_windows, -2)
+    for track in range(silent.shape[1]):
+        mask &= ~(has_silence[:, track] & (first[:, track] - prev_last == 1))
+        prev_last = np.where(has_silence[:, track], last[:, track], prev_last)
+
+    return mask
+
+
+def bar_nodes(words):
+
+    # Number of activations of each track in each bar (n_bars x n_tracks),
+    # counted on the packed words
+    return popcount(np.asarray(words, dtype=np.uint32)).astype(np.int64)
+
+
+def encode_notes(c_tensor):
+
+    # c_tensor: n_nodes x MAX_SIMU_TOKENS x 2 content of the active timesteps.
+    # Returns the n_notes_tot x 2 (pitch, duration) tokens of their notes,
+    # in order, and the number of notes of each node.
+    slots = c_tensor[:, 1:-1]
+    is_note = slots[..., 0] <= constants.MAX_PITCH_TOKEN
+    notes = slots[is_note].astype(np.uint8)
+
+    return notes, is_note.sum(axis=1).astype(np.uint8)
+
+
+def decode_notes(notes, n_notes):
+
+    # Inverse of encode_notes: builds the n_nodes x MAX_SIMU_TOKENS x 2
+    # content tensor (SOS token, notes, EOS token and PAD tokens)
+    n_nodes = len(n_notes)
+    content = np.empty((n_nodes, constants.MAX_SIMU_TOKENS, 2), np.uint8)
+    content[..., 0] = PitchToken.PAD.value
+    content[..., 1] = DurationToken.PAD.value
+    content[:, 0] = (PitchToken.SOS.value, DurationToken.SOS.value)
+
+    nodes = np.repeat(np.arange(n_nodes), n_notes)
+    first = np.cumsum(n_notes, dtype=np.int64) - n_notes
+    slots = np.arange(len(nodes)) - np.repeat(first, n_notes) + 1
+    content[nodes, slots] = notes
+    content[np.arange(n_nodes), n_notes.astype(np.int64) + 1] = \
+        (PitchToken.EOS.value, DurationToken.EOS.value)
+
+    return content
+
+
+def note_offsets(words, n_notes):
+
+    # Offsets of the nodes of each bar and of the notes of each node, given
+    # the packed structure (n_bars x n_tracks) and the number of notes of each
+    # node of a shard
+    bar_n_nodes = bar_nodes(words).sum(axis=1)
+    node_ptr = np.concatenate([[0], np.cumsum(bar_n_nodes)])
+    note_ptr = np.concatenate([[0], np.cumsum(n_notes, dtype=np.int64)])
+
+    return node_ptr, note_ptr
+
+
+class Manifest():
+
+    # Per-sample metadata of a dataset (see SongShardReader.windows):
+    # - source: index of the MIDI file of the sample in sources
+    # - subsong: index of the track combination of the file
+    # - window: index of the first bar of the sample in the subsong
+    # - n_nodes, n_edges: size of the sample graph
+    # - track_acts: number of activations of each track (n_samples x n_tracks)
+    def __init__(self, sources, source, subsong, window, n_nodes, n_edges,
+                 track_acts):
+        self.sources = sources
+        self.source = source
+        self.subsong = subsong
+        self.window = window
+        self.n_nodes = n_nodes
+        self.n_edges = n_edges
+        self.track_acts = track_acts
+
+    def __len__(self):
+        return len(self.source)
+
+    def select(self, min_nodes=None, max_nodes=None, tracks=None,
+               sources=None):
+
+        # Boolean mask of the samples whose graph has between min_nodes and
+        # max_nodes nodes, where all the given tracks are active and which
+        # come from one of the given source files
+        mask = np.ones(len(self), dtype=bool)
+
+        if min_nodes is not None:
+            mask &= self.n_nodes >= min_nodes
+        if max_nodes is not None:
+            mask &= self.n_nodes <= max_nodes
+        if tracks is not None:
+            mask &= np.all(self.track_acts[:, list(tracks)] > 0, axis=1)
+        if sources is not None:
+            source_ids = np.flatnonzero(np.isin(self.sources, list(sources)))
+            mask &= np.isin(self.source, source_ids)
+
+        return mask
+
+
+class SongShardWriter():
+
+    # Shards are flushed by the caller (see is_full), so that the caller
+    # knows which subsongs are on disk. Each flush also
+    # writes the song table and the index, so that a dataset is always
+    # readable up to its last flushed shard and its writing can be resumed
+    # (see resume).
+    def __init__(self, dir, shard_size=65536, compress=False, block_size=64,
+                 **meta):
+        self.dir = dir
+        # Minimum number of bars of each shard (subsongs are not split)
+        self.shard_size = shard_size
+        # Whether notes are compressed, in blocks of block_size bars
+        self.compress = compress
+        self.block_size = block_size
+        # Preprocessing parameters (e.g. resolution)
+        self.meta = dict(meta, layout='songs', compressed=compress,
+                         block_size=block_size)
+
+        self.shard_lens = []
+        self.c_buffer = []
+        self.n_buffer = []
+        self.s_buffer = []
+        self.e_buffer = []
+        self.n_buffered = 0
+        self.infos = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return len(self.infos)
+
+    @classmethod
+    def resume(cls, dir, shard_size=65536):
+
+        # Writer that appends shards to the dataset in dir
+        index = read_index(dir)
+        shard_lens = index.pop('shard_lens')
+        index.pop('layout')
+        compress = index.pop('compressed')
+        block_size = index.pop('block_size')
+        writer = cls(dir, shard_size, compress, block_size, **index)
+        writer.shard_lens = shard_lens
+
+        table = SongTable.load(dir).truncate(sum(shard_lens))
+        for i in range(len(table)):
+            first, n_bars = table.first_bar[i], table.n_bars[i]
+            writer.infos.append({
+                'source': table.sources[table.source[i]],
+                'subsong': int(table.subsong[i]),
+                'bar_n_edges': table.bar_n_edges[first:first+n_bars]
+            })
+
+        return writer
+
+    def is_full(self):
+        return self.n_buffered >= self.shard_size
+
+    def add(self, c_tensor, s_tensor, info, edges=None):
+
+        # c_tensor: n_bars x n_tracks x n_timesteps x MAX_SIMU_TOKENS x 2
+        # s_tensor: n_bars x n_tracks packed structure tensor
+        # info: subsong metadata (see SongTable.from_infos)
+        # edges: n_edges x 4 edge list of the bar graphs, sorted by bar, with
+        # node labels local to each bar. info['bar_n_edges'] holds the number
+        # of edges of each bar. Edges must be given either for all the
+        # subsongs or for none of them.
+        active = unpack_structure_np(s_tensor, c_tensor.shape[2])
+        notes, n_notes = encode_notes(c_tensor[active])
+        self.c_buffer.append(notes)
+        self.n_buffer.append(n_notes)
+        self.s_buffer.append(s_tensor)
+        self.infos.append(info)
+        if edges is not None:
+            self.e_buffer.append(edges)
+        self.n_buffered += len(s_tensor)
+
+    def flush(self):
+
+        if not self.s_buffer:
+            return
+
+        shard = len(self.shard_lens)
+        notes = np.concatenate(self.c_buffer)
+        n_notes = np.concatenate(self.n_buffer)
+        structure = np.concatenate(self.s_buffer)
+        np.save(structure_path(self.dir, shard), structure)
+        np.save(n_notes_path(self.dir, shard), n_notes)
+
+        if self.compress:
+            # Notes of each block of bars, compressed separately
+            node_ptr, note_ptr = note_offsets(structure, n_notes)
+            first_bars = np.r_[0:len(structure):self.block_size,
+                               len(structure)]
+            bounds = note_ptr[node_ptr[first_bars]]
+            blocks = [zlib.compress(notes[start:stop].tobytes())
+                      for start, stop in zip(bounds[:-1], bounds[1:])]
+            block_ptr = np.cumsum([0] + [len(block) for block in blocks])
+            np.save(notes_path(self.dir, shard),
+                    np.frombuffer(b''.join(blocks), dtype=np.uint8))
+            np.save(block_ptr_path(self.dir, shard), block_ptr)
+        else:
+            np.save(notes_path(self.dir, shard), notes)
+
+        if self.e_buffer:
+            # Offsets of the edges of each bar of the shard
+            infos = self.infos[len(self.infos)-len(self.s_buffer):]
+            bar_n_edges = np.concatenate([info['bar_n_edges']
+                                          for info in infos])
+            edge_ptr = np.concatenate([[0], np.cumsum(bar_n_edges)])
+            np.save(edges_path(self.dir, shard),
+                    np.concatenate(self.e_buffer).astype(np.uint16))
+            np.save(edge_ptr_path(self.dir, shard), edge_ptr)
+            self.meta['graphs'] = True
+
+        self.shard_lens.append(self.n_buffered)
+        self.c_buffer = []
+        self.n_buffer = []
+        self.s_buffer = []
+        self.e_buffer = []
+        self.n_buffered = 0
+
+        self._write_index()
+
+    def _write_index(self):
+
+        SongTable.from_infos(self.infos).save(self.dir)
+
+        # The index is written last, so that a directory is only recognized
+        # as a dataset once its shards have been written. It is replaced
+        # atomically, so that an interrupted write leaves the previous one.
+        index = dict(self.meta, shard_lens=self.shard_lens)
+        path = os.path.join(self.dir, INDEX_FILENAME)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(index, f)
+        os.replace(path + '.tmp', path)
+
+    def close(self):
+
+        self.flush()
+        self._write_index()
+
+
+class SongTable():
+
+    # Metadata of the subsongs of a song dataset:
+    # - source: index of the MIDI file of the subsong in sources
+    # - subsong: index of the track combination of the file
+    # - first_bar: index of the first bar of the subsong in the dataset
+    # - n_bars: number of bars of the subsong
+    # - bar_n_edges: number of edges of the graph of each bar of the dataset
+    def __init__(self, sources, source, subsong, first_bar, n_bars,
+                 bar_n_edges):
+        self.sources = sources
+        self.source = source
+        self.subsong = subsong
+        self.first_bar = first_bar
+        self.n_bars = n_bars
+        self.bar_n_edges = bar_n_edges
+
+    def __len__(self):
+        return len(self.source)
+
+    @classmethod
+    def from_infos(cls, infos):
+
+        sources, source = np.unique([info['source'] for info in infos],
+                                    return_inverse=True)
+        subsong = np.array([info['subsong'] for info in infos],
+                           dtype=np.int32)
+        n_bars = np.array([len(info['bar_n_edges']) for info in infos],
+                          dtype=np.int64)
+        first_bar = np.concatenate([[0], np.cumsum(n_bars)[:-1]])
+        bar_n_edges = np.concatenate(
+            [np.zeros(0, dtype=np.int32)] +
+            [np.asarray(info['bar_n_edges'], dtype=np.int32)
+             for info in infos])
+
+        return cls(sources, source.astype(np.int32), subsong,
+                   first_bar.astype(np.int64), n_bars, bar_n_edges)
+
+    @classmethod
+    def load(cls, dir):
+
+        with np.load(os.path.join(dir, SONGS_FILENAME)) as f:
+            return cls(**{k: f[k] for k in f.files})
+
+    def save(self, dir):
+
+        # The table is replaced atomically (see SongShardWriter)
+        path = os.path.join(dir, SONGS_FILENAME)
+        with open(path + '.tmp', 'wb') as f:
+            np.savez(f, sources=self.sources, source=self.source,
+                     subsong=self.subsong, first_bar=self.first_bar,
+                     n_bars=self.n_bars, bar_n_edges=self.bar_n_edges)
+        os.replace(path + '.tmp', path)
+
+    def truncate(self, n_bars_tot):
+
+        # Table of the subsongs in the first n_bars_tot bars of the dataset.
+        # The table of an interrupted write can be ahead of the index.
+        n_songs = int(np.searchsorted(self.first_bar + self.n_bars,
+                                      n_bars_tot, side='right'))
+
+        return SongTable(self.sources, self.source[:n_songs],
+                         self.subsong[:n_songs], self.first_bar[:n_songs],
+                         self.n_bars[:n_songs], self.bar_n_edges[:n_bars_tot])
+
+
+class SongShardReader():
+
+    # Reader of song datasets. Shards are indexed by bar.
+    def __init__(self, dir, max_cached_blocks=8):
+        self.dir = dir
+
+        self.index = read_index(dir)
+
+        # offsets[k] is the index of the first bar of shard k
+        self.offsets = np.cumsum([0] + self.index['shard_lens'])
+
+        # Whether shards store the edges of the bar graphs
+        self.graphs = self.index.get('graphs', False)
+
+        self.table = SongTable.load(dir).truncate(len(self))
+        self.n_timesteps = 4 * self.index['resolution']
+        self.compressed = self.index['compressed']
+        self.block_size = self.index['block_size']
+
+        # Memory maps are opened lazily by each process
+        self.structure = {}
+        self.edges = {}
+        self.edge_ptr = {}
+        self.n_notes = {}
+        self.notes = {}
+        self.block_ptr = {}
+        self.node_ptr = {}
+        self.note_ptr = {}
+        # Last decompressed blocks of notes (see _block)
+        self.max_cached_blocks = max_cached_blocks
+        self.blocks = OrderedDict()
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def __getstate__(self):
+
+        # Do not share memory maps with DataLoader workers
+        state = self.__dict__.copy()
+        for key in ['structure', 'edges', 'edge_ptr', 'n_notes', 'notes',
+                    'block_ptr', 'node_ptr', 'note_ptr']:
+            state[key] = {}
+        state['blocks'] = OrderedDict()
+
+        return state
+
+    def _open(self, shard):
+
+        if shard not in self.structure:
+            self.structure[shard] = np.load(structure_path(self.dir, shard),
+                                            mmap_mode='r')
+            self.n_notes[shard] = np.load(n_notes_path(self.dir, shard))
+            self.notes[shard] = np.load(notes_path(self.dir, shard),
+                                        mmap_mode='r')
+            if self.compressed:
+                self.block_ptr[shard] = np.load(block_ptr_path(self.dir,
+                                                               shard))
+            self.node_ptr[shard], self.note_ptr[shard] = note_offsets(
+                self.structure[shard], self.n_notes[shard])
+            if self.graphs:
+                self.edges[shard] = np.load(edges_path(self.dir, shard),
+                                            mmap_mode='r')
+                self.edge_ptr[shard] = np.load(edge_ptr_path(self.dir, shard))
+
+    def shard_of(self, bars):
+        return np.searchsorted(self.offsets, bars, side='right') - 1
+
+    def _block(self, shard, block):
+
+        # Decompressed notes of a block of bars. The last blocks are kept,
+        # since consecutive windows share their blocks.
+        key = (shard, block)
+        if key not in self.blocks:
+            ptr = self.block_ptr[shard]
+            data = zlib.decompress(self.notes[shard][ptr[block]:ptr[block+1]])
+            self.blocks[key] = np.frombuffer(data, np.uint8).reshape(-1, 2)
+            if len(self.blocks) > self.max_cached_blocks:
+                self.blocks.popitem(last=False)
+        else:
+            self.blocks.move_to_end(key)
+
+        return self.blocks[key]
+
+    def _content(self, shard, row, n_bars):
+
+        # Content of the active timesteps of n_bars bars from row
+        # (n_nodes x MAX_SIMU_TOKENS x 2)
+        node_ptr, note_ptr = self.node_ptr[shard], self.note_ptr[shard]
+        first, last = node_ptr[row], node_ptr[row+n_bars]
+        start, stop = note_ptr[first], note_ptr[last]
+
+        if self.compressed:
+            blocks = range(row // self.block_size,
+                           (row + n_bars - 1) // self.block_size + 1)
+            notes = np.concatenate([self._block(shard, block)
+                                    for block in blocks])
+            offset = note_ptr[node_ptr[blocks[0] * self.block_size]]
+            notes = notes[start-offset:stop-offset]
+        else:
+            notes = self.notes[shard][start:stop]
+
+        return decode_notes(notes, self.n_notes[shard][first:last])
+
+    def load_structure(self):
+
+        # Packed structure tensor of all the bars of the dataset
+        # (n_bars_tot x n_tracks)
+        return np.concatenate([np.load(structure_path(self.dir, shard))
+                               for shard in range(len(self.offsets) - 1)])
+
+    def windows(self, n_bars):
+
+        # First bars of the windows of n_bars bars that do not cross subsong
+        # boundaries and pass the silence filters, along with the manifest of
+        # the samples they define
+        words = self.load_structure()
+        n_windows = max(len(words) - n_bars + 1, 0)
+
+        song = np.repeat(np.arange(len(self.table)), self.table.n_bars)
+        pos = np.arange(len(words)) - self.table.first_bar[song]
+        fits = pos[:n_windows] + n_bars <= self.table.n_bars[song[:n_windows]]
+        starts = np.flatnonzero(window_mask(words != 0, n_bars) & fits)
+
+        # Window sizes from prefix sums over bars
+        def window_sums(x):
+            cum = np.concatenate([np.zeros((1,) + x.shape[1:], x.dtype),
+                                  np.cumsum(x, axis=0)])
+            return (cum[starts + n_bars] - cum[starts]).astype(np.int32)
+
+        track_acts = window_sums(bar_nodes(words))
+        n_edges = window_sums(self.table.bar_n_edges.astype(np.int64))
+
+        manifest = Manifest(self.table.sources, self.table.source[song[starts]],
+                            self.table.subsong[song[starts]],
+                            pos[starts].astype(np.int32),
+                            track_acts.sum(axis=1).astype(np.int32),
+                            n_edges, track_acts)
+
+        return starts, manifest
+
+    def window(self, start, n_bars):
+
+        # Returns the content of the active timesteps of the n_bars bars from
+        # bar start (n_nodes x MAX_SIMU_TOKENS x 2, in bar-major order), their
+        # boolean structure tensor (n_bars x n_tracks x n_timesteps) and their
+        # edge list along with the number of edges of each bar (None if edges
+        # are not stored)
+        shard = int(self.shard_of(start))
+        row = start - self.offsets[shard]
+        self._open(shard)
+
+        s_tensor = unpack_structure_np(self.structure[shard][row:row+n_bars],
+                                       self.n_timesteps)
+        c_tensor = self._content(shard, row, n_bars)
+
+        edges = bar_n_edges = None
+        if self.graphs:
+            ptr = self.edge_ptr[shard]
+            edges = self.edges[shard][ptr[row]:ptr[row+n_bars]]
+            bar_n_edges = np.diff(ptr[row:row+n_bars+1])
+
+        return c_tensor, s_tensor, edges, bar_n_edges
@@ -0,0 +1,148 @@
+import os
+import itertools
+
+import numpy as np
+import pytest
+import torch
+
+import constants
+from constants import PitchToken, DurationToken, EdgeTypes
+from data import BucketBatchSampler, PolyphemusDataset, get_edges
+
+
+def make_dataset(dir, n_samples=10, n_bars=2, n_timesteps=32):
+
+    # Dataset of n_samples .npz files with a random note at each activation
+    rng = np.random.default_rng(0)
+    shape = (constants.N_TRACKS, n_bars * n_timesteps)
+    for i in range(n_samples):
+        c_tensor = np.zeros(shape + (constants.MAX_SIMU_TOKENS, 2), np.int16)
+        c_tensor[..., 0] = PitchToken.PAD.value
+        c_tensor[..., 1] = DurationToken.PAD.value
+        c_tensor[..., 0, :] = (PitchToken.SOS.value, DurationToken.SOS.value)
+        c_tensor[..., 1, :] = (PitchToken.EOS.value, DurationToken.EOS.value)
+        s_tensor = rng.random(shape) < 0.2
+        c_tensor[s_tensor, 1] = (60, 3)
+        c_tensor[s_tensor, 2] = (PitchToken.EOS.value, DurationToken.EOS.value)
+        np.savez(os.path.join(dir, '{}.npz'.format(i)), c_tensor=c_tensor,
+                 s_tensor=s_tensor)
+
+    return PolyphemusDataset(dir, n_bars)
+
+
+def make_sampler(**kwargs):
+    rng = np.random.default_rng(0)
+    n_nodes = rng.integers(20, 500, size=1000)
+    n_edges = 4 * n_nodes
+    return n_nodes, BucketBatchSampler(n_nodes, n_edges, max_nodes=400,
+                                       seed=0, **kwargs)
+
+
+def test_bucket_batch_sampler_min_batch_size():
+    n_nodes, sampler = make_sampler()
+    for epoch in range(5):
+        sampler.set_epoch(epoch)
+        batches = list(sampler)
+        assert min(len(batch) for batch in batches) >= 2
+        # Each sample is used exactly once
+        assert sorted(sum(batches, [])) == list(range(len(n_nodes)))
+
+
+def test_bucket_batch_sampler_drop_last():
+    n_nodes, sampler = make_sampler(drop_last=True)
+    batches = list(sampler)
+    assert min(len(batch) for batch in batches) >= 2
+    assert len(sum(batches, [])) <= len(n_nodes)
+
+
+def test_bucket_batch_sampler_epoch():
+    _, sampler = make_sampler()
+    sampler.set_epoch(3)
+    n_batches = len(sampler)
+    batches = list(sampler)
+    # Iterating does not move to the next epoch
+    assert len(sampler) == n_batches == len(batches)
+    assert list(sampler) == batches
+    sampler.set_epoch(4)
+    assert list(sampler) != batches
+
+
+def test_split_file_mismatch(tmp_path):
+    dataset = make_dataset(str(tmp_path))
+    path = str(tmp_path / 'split.npz')
+    tr_set, ts_set = dataset.split((8, 2), path)
+
+    # The same split is loaded with the same lengths
+    split = dataset.split((8, 2), path)
+    assert [list(part.indices) for part in split] == \
+        [list(tr_set.indices), list(ts_set.indices)]
+
+    # A 2-part split cannot be used as a 3-part split
+    with pytest.raises(ValueError):
+        dataset.split((6, 2, 2), path)
+
+    # Nor on another dataset
+    with pytest.raises(ValueError):
+        tr_set.split((6, 2), path)
+
+
+def bar_edges(bar):
+
+    # Reference edge list of a single bar (n_tracks x n_timesteps), built
+    # one track, timestep and pair of consecutive timesteps at a time
+    labels = -np.ones(bar.shape, dtype=np.int64)
+    labels[bar] = np.arange(bar.sum())
+    tracks, tss = np.nonzero(bar)
+
+    track_edges = []
+    for track in range(bar.shape[0]):
+        active = tss[tracks == track]
+        edges = [(labels[track, t1], labels[track, t2],
+                  EdgeTypes.TRACK.value + track, t2 - t1)
+                 for t1, t2 in zip(active[:-1], active[1:])]
+        track_edges += edges + [(v, u, t, d) for (u, v, t, d) in edges]
+
+    onset_edges = []
+    for ts in range(bar.shape[1]):
+        active = tracks[tss == ts]
+        edges = [(labels[track1, ts], labels[track2, ts],
+                  EdgeTypes.ONSET.value, 0)
+                 for track1, track2 in itertools.combinations(active, 2)]
+        onset_edges += edges + [(v, u, t, d) for (u, v, t, d) in edges]
+
+    next_edges = []
+    active_tss = np.flatnonzero(bar.any(axis=0))
+    for t1, t2 in zip(active_tss[:-1], active_tss[1:]):
+        next_edges += [(labels[track1, t1], labels[track2, t2],
+                        EdgeTypes.NEXT.value, t2 - t1)
+                       for track1 in tracks[tss == t1]
+                       for track2 in tracks[tss == t2] if track1 != track2]
+
+    edges = track_edges + onset_edges + next_edges
+    if not edges:
+        # Fake self-edge of single-node bars
+        edges = [(0, 0, 0, 0)]
+
+    return np.array(edges, dtype=np.int64).reshape(-1, 4)
+
+
+def test_get_edges():
+    rng = np.random.default_rng(0)
+    for density in [0.02, 0.1, 0.3]:
+        s_tensor = rng.random((6, constants.N_TRACKS, 32)) < density
+        # Empty bar, with the fake activation added by graph construction,
+        # and single-node bar
+        s_tensor[1] = False
+        s_tensor[1, 0, 0] = True
+        s_tensor[2] = False
+        s_tensor[2, 3, 7] = True
+
+        expected, first_node = [], 0
+        for bar in s_tensor:
+            edges = bar_edges(bar)
+            edges[:, :2] += first_node
+            expected.append(edges)
+            first_node += bar.sum()
+
+        edges = get_edges(torch.from_numpy(s_tensor))
+        assert np.array_equal(edges.numpy(), np.concatenate(expected))
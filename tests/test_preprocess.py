@@ -0,0 +1,131 @@
+import os
+import json
+
+import numpy as np
+import pytest
+
+import constants
+import preprocess
+from constants import PitchToken, DurationToken
+from packing import pack_structure_np
+from shards import SongShardReader, SongShardWriter
+
+
+N_TIMESTEPS = 32
+
+
+def reference_tokenize_notes(times, pitches, durations, length):
+
+    # Note by note version of tokenize_notes
+    content = np.zeros((length, constants.MAX_SIMU_TOKENS, 2), np.int16)
+    content[..., 0] = PitchToken.PAD.value
+    content[..., 1] = DurationToken.PAD.value
+    content[:, 0] = (PitchToken.SOS.value, DurationToken.SOS.value)
+    counter = np.ones(length, dtype=np.int64)
+    for t, pitch, dur in zip(times, pitches, durations):
+        if counter[t] >= constants.MAX_SIMU_TOKENS - 1:
+            continue
+        pitch = max(min(pitch, constants.MAX_PITCH_TOKEN), 0)
+        dur = max(min(dur, constants.MAX_DUR_TOKEN + 1), 1)
+        content[t, counter[t]] = (pitch, dur - 1)
+        counter[t] += 1
+    content[np.arange(length), counter] = (PitchToken.EOS.value,
+                                           DurationToken.EOS.value)
+
+    return content, counter > 1
+
+
+def test_tokenize_notes():
+    rng = np.random.default_rng(0)
+    length = 64
+    # Timesteps 3 and 10 hold more notes than MAX_SIMU_TOKENS-2
+    times = np.concatenate([rng.integers(0, length, 100), np.full(20, 3),
+                            np.full(constants.MAX_SIMU_TOKENS, 10)])
+    times = rng.permutation(times)
+    # Pitches and durations out of the token ranges are clipped
+    pitches = rng.integers(-10, constants.MAX_PITCH_TOKEN + 10, len(times))
+    durations = rng.integers(-2, constants.MAX_DUR_TOKEN + 10, len(times))
+
+    content, activations = preprocess.tokenize_notes(times, pitches,
+                                                     durations, length)
+    expected_content, expected_activations = reference_tokenize_notes(
+        times, pitches, durations, length)
+    assert np.array_equal(content, expected_content)
+    assert np.array_equal(activations, expected_activations)
+
+
+def fake_midi_file(filepath, resolution, precompute_graphs=False,
+                   transpose=False):
+
+    # One subsong of one bar per file, with a single note whose pitch
+    # identifies the file
+    pitch = int(os.path.basename(filepath).split('.')[0])
+    bars = np.zeros((1, constants.N_TRACKS, N_TIMESTEPS), dtype=bool)
+    bars[0, 0, 0] = True
+    c_tensor = np.zeros(bars.shape + (constants.MAX_SIMU_TOKENS, 2),
+                        np.int16)
+    c_tensor[..., 0] = PitchToken.PAD.value
+    c_tensor[..., 1] = DurationToken.PAD.value
+    c_tensor[0, 0, 0, :3] = [(PitchToken.SOS.value, DurationToken.SOS.value),
+                             (pitch, 0),
+                             (PitchToken.EOS.value, DurationToken.EOS.value)]
+    info = {'source': filepath, 'subsong': 0,
+            'bar_n_edges': np.zeros(1, dtype=np.int64)}
+
+    return [(c_tensor, pack_structure_np(bars), info, None)], None
+
+
+def interrupt_flush(monkeypatch, n):
+
+    # Makes the n-th shard flush raise, as an interruption would
+    flush = SongShardWriter.flush
+    calls = []
+
+    def interrupted_flush(self):
+        calls.append(None)
+        if len(calls) == n:
+            raise KeyboardInterrupt
+        flush(self)
+
+    monkeypatch.setattr(SongShardWriter, 'flush', interrupted_flush)
+
+
+def test_resume_twice(tmp_path, monkeypatch):
+
+    midi_dir = tmp_path / 'midi'
+    midi_dir.mkdir()
+    files = ['{}.mid'.format(pitch) for pitch in range(20)]
+    for file in files:
+        (midi_dir / file).touch()
+    monkeypatch.setattr(preprocess, 'preprocess_midi_file', fake_midi_file)
+
+    # Journal left by a previous dataset in the same directory
+    out_dir = tmp_path / 'out'
+    out_dir.mkdir()
+    (out_dir / preprocess.JOURNAL_FILENAME).write_text(''.join(
+        json.dumps({'file': file, 'status': 'ok', 'subsongs': 1, 'shard': 0})
+        + '\n' for file in files))
+
+    def run(shard_size, resume):
+        preprocess.preprocess_midi_dataset(str(midi_dir), str(out_dir),
+                                           resolution=N_TIMESTEPS // 4,
+                                           shard_size=shard_size,
+                                           resume=resume)
+
+    # The second run writes smaller shards, so the records of the shard
+    # interrupted in the first run cover files that are not in its shard
+    interrupt_flush(monkeypatch, 2)
+    with pytest.raises(KeyboardInterrupt):
+        run(8, False)
+    interrupt_flush(monkeypatch, 2)
+    with pytest.raises(KeyboardInterrupt):
+        run(4, True)
+    monkeypatch.undo()
+    monkeypatch.setattr(preprocess, 'preprocess_midi_file', fake_midi_file)
+    run(4, True)
+
+    reader = SongShardReader(str(out_dir))
+    sources = reader.table.sources[reader.table.source]
+    assert sorted(sources) == sorted(files)
+    pitches = [reader.window(bar, 1)[0][0, 1, 0] for bar in range(len(reader))]
+    assert sorted(pitches) == list(range(20))
@@ -0,0 +1,113 @@
+import numpy as np
+
+import constants
+from constants import PitchToken, DurationToken
+from packing import pack_structure_np
+from shards import (SongShardReader, SongShardWriter, decode_notes,
+                    encode_notes, window_mask)
+
+
+N_TIMESTEPS = 32
+
+
+def random_content(rng, active):
+
+    # Content tensor with a random number of random notes at each activation
+    content = np.zeros(active.shape + (constants.MAX_SIMU_TOKENS, 2),
+                       np.int16)
+    content[..., 0] = PitchToken.PAD.value
+    content[..., 1] = DurationToken.PAD.value
+    content[..., 0, :] = (PitchToken.SOS.value, DurationToken.SOS.value)
+    n_notes = np.where(active, rng.integers(
+        1, constants.MAX_SIMU_TOKENS - 1, active.shape), 0)
+    for idx in np.ndindex(active.shape):
+        n = n_notes[idx]
+        pitches = rng.integers(0, constants.MAX_PITCH_TOKEN + 1, n)
+        durations = rng.integers(0, constants.MAX_DUR_TOKEN + 1, n)
+        content[idx][1:n+1] = np.stack((pitches, durations), axis=1)
+        content[idx][n+1] = (PitchToken.EOS.value, DurationToken.EOS.value)
+
+    return content
+
+
+def reference_window_mask(acts, n_bars):
+
+    # Silence filters of the original preprocessing, applied to each window
+    # (acts: n_bars_tot x n_tracks)
+    mask = []
+    for i in range(len(acts) - n_bars + 1):
+        bars_acts = acts[i:i+n_bars].T
+        if n_bars > 1:
+            keep = (1 not in np.diff(np.where(bars_acts == 0)[1]) and
+                    np.all(np.any(bars_acts, axis=0)))
+        else:
+            keep = np.any(bars_acts)
+        mask.append(keep)
+
+    return np.array(mask, dtype=bool)
+
+
+def test_window_mask():
+    rng = np.random.default_rng(0)
+    for density in [0.3, 0.6, 0.9]:
+        acts = rng.random((200, constants.N_TRACKS)) < density
+        # Completely silent bars
+        acts[[10, 50, 51]] = False
+        for n_bars in [1, 2, 3, 4, 8]:
+            assert np.array_equal(window_mask(acts, n_bars),
+                                  reference_window_mask(acts, n_bars))
+
+    # Subsongs shorter than the windows
+    assert len(window_mask(acts[:3], 4)) == 0
+
+
+def test_encode_decode_notes():
+    rng = np.random.default_rng(0)
+    active = np.ones(100, dtype=bool)
+    c_tensor = random_content(rng, active)
+    notes, n_notes = encode_notes(c_tensor)
+    assert len(notes) == n_notes.sum()
+    assert np.array_equal(decode_notes(notes, n_notes), c_tensor)
+
+    # No nodes
+    notes, n_notes = encode_notes(c_tensor[:0])
+    assert decode_notes(notes, n_notes).shape == c_tensor[:0].shape
+
+
+def test_compressed_windows(tmp_path):
+    rng = np.random.default_rng(0)
+
+    # Subsongs with silent bars, written in several shards of compressed
+    # blocks of 2 bars
+    subsongs = []
+    writer = SongShardWriter(str(tmp_path), shard_size=16, compress=True,
+                             block_size=2, resolution=N_TIMESTEPS // 4)
+    for subsong in range(8):
+        n_bars = int(rng.integers(1, 8))
+        bars = rng.random((n_bars, constants.N_TRACKS, N_TIMESTEPS)) < 0.1
+        bars[rng.random(n_bars) < 0.2] = False
+        c_tensor = random_content(rng, bars)
+        info = {'source': 'song.mid', 'subsong': subsong,
+                'bar_n_edges': np.zeros(n_bars, dtype=np.int64)}
+        writer.add(c_tensor, pack_structure_np(bars), info)
+        if writer.is_full():
+            writer.flush()
+        subsongs.append((c_tensor, bars))
+    writer.close()
+
+    contents = np.concatenate([c for c, _ in subsongs])
+    structures = np.concatenate([s for _, s in subsongs])
+
+    reader = SongShardReader(str(tmp_path))
+    assert len(reader.offsets) > 2
+    for n_bars in [1, 2, 3, 5]:
+        for start in range(len(reader) - n_bars + 1):
+            shard = int(reader.shard_of(start))
+            if start + n_bars > reader.offsets[shard + 1]:
+                # Windows do not cross shards
+                continue
+            c_tensor, s_tensor, _, _ = reader.window(start, n_bars)
+            window = slice(start, start + n_bars)
+            assert np.array_equal(s_tensor, structures[window])
+            assert np.array_equal(c_tensor,
+                                  contents[window][structures[window]])
@@ -5,9 +5,10 @@ import uuid
 
 import torch
 import os
-from torch.utils.data import random_split
-from torch_geometric.loader import DataLoader
-from data import PolyphemusDataset
+from torch.utils.data import DataLoader
+from data import PolyphemusDataset, BarGraphCache, BucketBatchSampler
+from data import PolyphemusStream, RandomTranspose
+from data import save_split, collate_graphs
 import torch.optim as optim
 
 from model import VAE
@@ -101,6 +102,55 @@ def main():
         "split. Default is 0.1. This value is ignored if the --eval option is "
         "not specified."
     )
+    parser.add_argument(
+        '--split_file',
+        type=str,
+        help="Path of a .npz file with the train/validation/test split of the "
+        "dataset. If the file exists, the split is loaded from it, otherwise "
+        "a new random split is created and saved to it. In any case, the "
+        "split is also saved in the model directory."
+    )
+    parser.add_argument(
+        '--graph_cache_mb',
+        type=int,
+        default=0,
+        help="Size in MB of the cache of bar graphs kept by each data loading "
+        "process. Default is 0 (no cache)."
+    )
+    parser.add_argument(
+        '--sample_cache_mb',
+        type=int,
+        default=0,
+        help="Size in MB of the cache of decoded samples, which is kept in "
+        "shared memory and used by all the data loading processes. If it is "
+        "large enough, the whole dataset is decoded only once. "
+        "Default is 0 (no cache)."
+    )
+    parser.add_argument(
+        '--stream',
+        action='store_true',
+        default=False,
+        help="Flag to read the training samples sequentially, shard by "
+        "shard, instead of at random. Samples are shuffled by shuffling the "
+        "order of the shards and through a shuffle buffer. Requires a sharded "
+        "dataset and is not compatible with max_nodes."
+    )
+    parser.add_argument(
+        '--shuffle_buffer',
+        type=int,
+        default=1024,
+        help="Number of samples in the shuffle buffer of each data loading "
+        "process when the stream flag is set. Default is 1024."
+    )
+    parser.add_argument(
+        '--transpose',
+        action='store_true',
+        default=False,
+        help="Flag to randomly transpose the pitches of each training "
+        "sequence (from -5 to +6 semitones) every time it is loaded. Drums "
+        "are not transposed. Use it with datasets preprocessed without the "
+        "--transpose flag of preprocess.py."
+    )
     parser.add_argument(
         '--max_epochs',
         type=int,
@@ -130,10 +180,18 @@ def main():
     
     n_bars = training_config['model']['n_bars']
     batch_size = training_config['batch_size']
+    # If max_nodes is set, batches are formed under a budget of nodes (and
+    # edges, if max_edges is set) instead of having batch_size samples
+    max_nodes = training_config.get('max_nodes')
+    max_edges = training_config.get('max_edges')
+    iters_to_accumulate = training_config.get('iters_to_accumulate', 1)
         
     print("Preparing datasets and dataloaders...")
     
-    dataset = PolyphemusDataset(args.dataset_dir, n_bars)
+    graph_cache = (BarGraphCache(args.graph_cache_mb * 2**20)
+                   if args.graph_cache_mb > 0 else None)
+    dataset = PolyphemusDataset(args.dataset_dir, n_bars, graph_cache,
+                                args.sample_cache_mb)
     
     tr_len = int(args.tr_split * len(dataset))
     
@@ -145,16 +203,39 @@ def main():
         ts_len = len(dataset) - tr_len
         lengths = (tr_len, ts_len)
         
-    split = random_split(dataset, lengths)
+    split = dataset.split(lengths, args.split_file)
     tr_set = split[0]
     vl_set = split[1] if args.eval else None
 
-    trainloader = DataLoader(tr_set, batch_size=batch_size, shuffle=True, 
-                             num_workers=args.num_workers)
+    if args.stream and max_nodes is not None:
+        parser.error("--stream cannot be used with max_nodes")
+
+    def make_loader(subset, train):
+        # Only training batches are augmented with random transpositions
+        collate_fn = (RandomTranspose() if args.transpose and train
+                      else collate_graphs)
+        if args.stream and train:
+            stream = PolyphemusStream(subset, buffer_size=args.shuffle_buffer)
+            # Drop the partial last batch of each worker
+            return DataLoader(stream, batch_size=batch_size,
+                              num_workers=args.num_workers,
+                              collate_fn=collate_fn, drop_last=True)
+        if max_nodes is None:
+            return DataLoader(subset, batch_size=batch_size, shuffle=train,
+                              num_workers=args.num_workers,
+                              collate_fn=collate_fn)
+        n_nodes, n_edges = subset.graph_sizes()
+        sampler = BucketBatchSampler(n_nodes, n_edges, max_nodes=max_nodes,
+                                     max_edges=max_edges, shuffle=train)
+        return DataLoader(subset, batch_sampler=sampler,
+                          num_workers=args.num_workers,
+                          collate_fn=collate_fn)
+
+    trainloader = make_loader(tr_set, train=True)
     if args.eval:
-        validloader = DataLoader(vl_set, batch_size=batch_size, shuffle=False,
-                                 num_workers=args.num_workers)
-        eval_every = len(trainloader)
+        validloader = make_loader(vl_set, train=False)
+        # Eval at the end of each epoch by default (see PolyphemusTrainer)
+        eval_every = args.eval_every
     else:
         validloader = None
         eval_every = None
@@ -189,6 +270,10 @@ def main():
     # Save config
     config_path = os.path.join(model_dir, 'configuration')
     torch.save(training_config, config_path) 
+
+    # Save the dataset split
+    save_split(os.path.join(model_dir, 'split.npz'),
+               [part.indices for part in split])
     
     print("Starting training...")
     print_divider()
@@ -202,6 +287,8 @@ def main():
         save_every=args.save_every,
         print_every=args.print_every,
         eval_every=eval_every,
+        iters_to_accumulate=iters_to_accumulate,
+        sample_cache=dataset.sample_cache,
         device=device
     )
     trainer.train(trainloader, validloader=validloader, epochs=args.max_epochs)
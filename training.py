@@ -5,7 +5,6 @@ from collections import defaultdict
 
 import torch
 import numpy as np
-import torch.nn.functional as F
 from torch import nn
 from tqdm.auto import tqdm
 import pprint
@@ -75,12 +74,22 @@ class ExpDecayLRScheduler():
         return self.lr
 
 
+def set_epoch(loader, epoch):
+
+    # Propagate the epoch to the dataset, batch sampler and collate function
+    # of the loader, if they depend on it (e.g. PolyphemusStream,
+    # BucketBatchSampler, RandomTranspose)
+    for obj in (loader.dataset, loader.batch_sampler, loader.collate_fn):
+        if hasattr(obj, 'set_epoch'):
+            obj.set_epoch(epoch)
+
+
 class PolyphemusTrainer():
 
     def __init__(self, model_dir, model, optimizer, init_lr=1e-4,
                  lr_scheduler=None, beta_scheduler=None, device=None, 
                  print_every=1, save_every=1, eval_every=100, 
-                 iters_to_accumulate=1, **kwargs):
+                 iters_to_accumulate=1, sample_cache=None, **kwargs):
         self.__dict__.update(kwargs)
 
         self.model_dir = model_dir
@@ -95,6 +104,8 @@ class PolyphemusTrainer():
         self.save_every = save_every
         self.eval_every = eval_every
         self.iters_to_accumulate = iters_to_accumulate
+        # Optional SampleCache of the dataset, whose stats are printed
+        self.sample_cache = sample_cache
 
         # Losses (ignoring PAD tokens)
         self.bce_unreduced = nn.BCEWithLogitsLoss(reduction='none')
@@ -126,6 +137,9 @@ class PolyphemusTrainer():
 
         for epoch in range(epochs):
             self.cur_epoch = epoch
+            set_epoch(trainloader, epoch)
+            # The number of batches may change across epochs
+            n_batches = len(trainloader)
             for batch_idx, graph in enumerate(trainloader):
                 self.cur_batch_idx = batch_idx
 
@@ -140,11 +154,11 @@ class PolyphemusTrainer():
                     # decoder
                     (s_logits, c_logits), mu, log_var = self.model(graph)
 
-                    # Compute losses
-                    tot_loss, losses = self._losses(
+                    # Compute losses and accuracies
+                    tot_loss, losses, accs = self._losses(
                         s_tensor, s_logits,
                         c_tensor, c_logits,
-                        mu, log_var
+                        mu, log_var, graph.is_drum
                     )
                     tot_loss = tot_loss / self.iters_to_accumulate
 
@@ -171,13 +185,6 @@ class PolyphemusTrainer():
                     if self.beta_scheduler is not None:
                         self.beta_scheduler.step()
 
-                # Compute accuracies
-                accs = self._accuracies(
-                    s_tensor, s_logits,
-                    c_tensor, c_logits,
-                    graph.is_drum
-                )
-
                 # Update the stats
                 append_dict(self.tr_losses, losses)
                 append_dict(self.tr_accuracies, accs)
@@ -192,7 +199,7 @@ class PolyphemusTrainer():
                 if (self.tot_batches + 1) % self.print_every == 0:
                     print("Training on batch {}/{} of epoch {}/{} complete."
                           .format(batch_idx+1,
-                                  len(trainloader),
+                                  n_batches,
                                   epoch+1,
                                   epochs))
                     self._print_stats()
@@ -200,30 +207,9 @@ class PolyphemusTrainer():
 
                 # Eval on VL every `eval_every` gradient updates
                 if (validloader is not None and
+                        self.eval_every is not None and
                         (self.tot_batches + 1) % self.eval_every == 0):
-
-                    # Evaluate on VL
-                    print("\nEvaluating on validation set...\n")
-                    val_losses, val_accuracies = self.evaluate(validloader)
-
-                    # Update stats
-                    append_dict(self.val_losses, val_losses)
-                    append_dict(self.val_accuracies, val_accuracies)
-
-                    print("Val losses:")
-                    print(val_losses)
-                    print("Val accuracies:")
-                    print(val_accuracies)
-
-                    # Save model if VL loss (tot) reached a new minimum
-                    tot_loss = val_losses['tot']
-                    if tot_loss < self.min_val_loss:
-                        print("\nValidation loss improved.")
-                        print("Saving new best model to disk...\n")
-                        self._save_model('best_model')
-                        self.min_val_loss = tot_loss
-
-                    self.model.train()
+                    self._validate(validloader)
 
                 progress_bar.update(1)
 
@@ -239,6 +225,10 @@ class PolyphemusTrainer():
 
                 self.tot_batches += 1
 
+            # Without eval_every, eval on VL at the end of each epoch
+            if validloader is not None and self.eval_every is None:
+                self._validate(validloader)
+
         end = time.time()
         hours, rem = divmod(end-start, 3600)
         minutes, seconds = divmod(rem, 60)
@@ -247,6 +237,31 @@ class PolyphemusTrainer():
 
         self._save_model('checkpoint')
 
+    def _validate(self, validloader):
+
+        # Evaluate on VL
+        print("\nEvaluating on validation set...\n")
+        val_losses, val_accuracies = self.evaluate(validloader)
+
+        # Update stats
+        append_dict(self.val_losses, val_losses)
+        append_dict(self.val_accuracies, val_accuracies)
+
+        print("Val losses:")
+        print(val_losses)
+        print("Val accuracies:")
+        print(val_accuracies)
+
+        # Save model if VL loss (tot) reached a new minimum
+        tot_loss = val_losses['tot']
+        if tot_loss < self.min_val_loss:
+            print("\nValidation loss improved.")
+            print("Saving new best model to disk...\n")
+            self._save_model('best_model')
+            self.min_val_loss = tot_loss
+
+        self.model.train()
+
     def evaluate(self, loader):
 
         losses = defaultdict(list)
@@ -266,18 +281,12 @@ class PolyphemusTrainer():
                     # Forward pass, get the reconstructions
                     (s_logits, c_logits), mu, log_var = self.model(graph)
 
-                    _, losses_b = self._losses(
+                    _, losses_b, accs_b = self._losses(
                         s_tensor, s_logits,
                         c_tensor, c_logits,
-                        mu, log_var
+                        mu, log_var, graph.is_drum
                     )
 
-                accs_b = self._accuracies(
-                    s_tensor, s_logits,
-                    c_tensor, c_logits,
-                    graph.is_drum
-                )
-
                 # Save losses and accuracies
                 append_dict(losses, losses_b)
                 append_dict(accs, accs_b)
@@ -295,16 +304,22 @@ class PolyphemusTrainer():
 
         return avg_losses, avg_accs
 
-    def _losses(self, s_tensor, s_logits, c_tensor, c_logits, mu, log_var):
+    def _losses(self, s_tensor, s_logits, c_tensor, c_logits, mu, log_var,
+                is_drum):
+
+        # Losses and accuracies are computed together from the same logits
+        # and target token ids
+        # c_tensor: n_nodes x MAX_SIMU_TOKENS x 2 (pitch and duration ids)
 
         # Do not consider SOS token
-        c_tensor = c_tensor[..., 1:, :]
-        c_logits = c_logits.reshape(-1, c_logits.size(-1))
-        c_tensor = c_tensor.reshape(-1, c_tensor.size(-1))
+        pitch_true = c_tensor[:, 1:, 0]
+        dur_true = c_tensor[:, 1:, 1]
+        pitch_logits = c_logits[..., :constants.N_PITCH_TOKENS]
+        dur_logits = c_logits[..., constants.N_PITCH_TOKENS:]
 
         # Reshape logits to match s_tensor dimensions:
         # n_graphs (in batch) x n_tracks x n_timesteps
-        s_logits = s_tensor.reshape(-1, *s_logits.shape[2:])
+        s_logits = s_logits.reshape(-1, *s_logits.shape[2:])
 
         # Binary structure tensor loss (binary cross entropy)
         s_loss = self.bce_unreduced(
@@ -312,15 +327,16 @@ class PolyphemusTrainer():
         s_loss = torch.mean(s_loss)
 
         # Content tensor loss (pitches)
-        # argmax is used to obtain token ids from onehot rep
-        pitch_logits = c_logits[:, :constants.N_PITCH_TOKENS]
-        pitch_true = c_tensor[:, :constants.N_PITCH_TOKENS].argmax(dim=1)
-        pitch_loss = self.ce_p(pitch_logits, pitch_true)
+        pitch_loss = self.ce_p(
+            pitch_logits.reshape(-1, constants.N_PITCH_TOKENS),
+            pitch_true.reshape(-1)
+        )
 
         # Content tensor loss (durations)
-        dur_logits = c_logits[:, constants.N_PITCH_TOKENS:]
-        dur_true = c_tensor[:, constants.N_PITCH_TOKENS:].argmax(dim=1)
-        dur_loss = self.ce_d(dur_logits, dur_true)
+        dur_loss = self.ce_d(
+            dur_logits.reshape(-1, constants.N_DUR_TOKENS),
+            dur_true.reshape(-1)
+        )
 
         # Kullback-Leibler divergence loss
         # Derivation in Kingma, Diederik P., and Max Welling. "Auto-encoding
@@ -334,41 +350,52 @@ class PolyphemusTrainer():
         rec_loss = pitch_loss + dur_loss + s_loss
         tot_loss = rec_loss + self.beta*kld_loss
 
-        losses = {
-            'tot': tot_loss.item(),
-            'pitch': pitch_loss.item(),
-            'dur': dur_loss.item(),
-            'structure': s_loss.item(),
-            'reconstruction': rec_loss.item(),
-            'kld': kld_loss.item(),
-            'beta*kld': self.beta*kld_loss.item()
-        }
+        with torch.no_grad():
+            accs = self._accuracies(s_tensor, s_logits, pitch_true,
+                                    pitch_logits, dur_true, dur_logits,
+                                    is_drum)
 
-        return tot_loss, losses
+            # Stats are moved to the CPU all at once
+            stats = torch.stack([
+                tot_loss, pitch_loss, dur_loss, s_loss, rec_loss, kld_loss,
+                self.beta*kld_loss
+            ] + list(accs.values())).tolist()
 
-    def _accuracies(self, s_tensor, s_logits, c_tensor, c_logits, is_drum):
+        loss_names = ['tot', 'pitch', 'dur', 'structure', 'reconstruction',
+                      'kld', 'beta*kld']
+        losses = dict(zip(loss_names, stats[:len(loss_names)]))
+        accs = dict(zip(accs.keys(), stats[len(loss_names):]))
 
-        # Do not consider SOS token
-        c_tensor = c_tensor[..., 1:, :]
+        return tot_loss, losses, accs
 
-        # Reshape logits to match s_tensor dimensions:
-        # n_graphs (in batch) x n_tracks x n_timesteps
-        s_logits = s_tensor.reshape(-1, *s_logits.shape[2:])
+    def _accuracies(self, s_tensor, s_logits, pitch_true, pitch_logits,
+                    dur_true, dur_logits, is_drum):
+
+        # Reconstructed tokens (softmax does not change the argmax)
+        pitch_rec = torch.argmax(pitch_logits, dim=-1)
+        dur_rec = torch.argmax(dur_logits, dim=-1)
+
+        # Do not consider PAD tokens when computing accuracies
+        not_pad_p = (pitch_true != PitchToken.PAD.value)
+        not_pad_d = (dur_true != DurationToken.PAD.value)
+
+        correct_p = torch.logical_and(pitch_rec == pitch_true, not_pad_p)
+        correct_d = torch.logical_and(dur_rec == dur_true, not_pad_d)
 
         # Note accuracy considers both pitches and durations
-        note_acc = self._note_accuracy(c_logits, c_tensor)
+        note_acc = (torch.sum(torch.logical_and(correct_p, correct_d)) /
+                    torch.sum(not_pad_p))
 
-        pitch_acc = self._pitch_accuracy(c_logits, c_tensor)
+        pitch_acc = torch.sum(correct_p) / torch.sum(not_pad_p)
 
         # Compute pitch accuracies for drums and non drums separately
-        pitch_acc_drums = self._pitch_accuracy(
-            c_logits, c_tensor, drums=True, is_drum=is_drum
-        )
-        pitch_acc_non_drums = self._pitch_accuracy(
-            c_logits, c_tensor, drums=False, is_drum=is_drum
-        )
+        is_non_drum = torch.logical_not(is_drum)
+        pitch_acc_drums = (torch.sum(correct_p[is_drum]) /
+                           torch.sum(not_pad_p[is_drum]))
+        pitch_acc_non_drums = (torch.sum(correct_p[is_non_drum]) /
+                               torch.sum(not_pad_p[is_non_drum]))
 
-        dur_acc = self._duration_accuracy(c_logits, c_tensor)
+        dur_acc = torch.sum(correct_d) / torch.sum(not_pad_d)
 
         s_acc = self._structure_accuracy(s_logits, s_tensor)
         s_precision = self._structure_precision(s_logits, s_tensor)
@@ -376,97 +403,19 @@ class PolyphemusTrainer():
         s_f1 = (2*s_recall*s_precision / (s_recall+s_precision))
 
         accs = {
-            'note': note_acc.item(),
-            'pitch': pitch_acc.item(),
-            'pitch_drums': pitch_acc_drums.item(),
-            'pitch_non_drums': pitch_acc_non_drums.item(),
-            'dur': dur_acc.item(),
-            's_acc': s_acc.item(),
-            's_precision': s_precision.item(),
-            's_recall': s_recall.item(),
-            's_f1': s_f1.item()
+            'note': note_acc,
+            'pitch': pitch_acc,
+            'pitch_drums': pitch_acc_drums,
+            'pitch_non_drums': pitch_acc_non_drums,
+            'dur': dur_acc,
+            's_acc': s_acc,
+            's_precision': s_precision,
+            's_recall': s_recall,
+            's_f1': s_f1
         }
 
         return accs
 
-    def _pitch_accuracy(self, c_logits, c_tensor, drums=None, is_drum=None):
-
-        # When drums is None, just compute the global pitch accuracy without
-        # distinguishing between drum and non drum pitches
-        if drums is not None:
-            if drums:
-                c_logits = c_logits[is_drum]
-                c_tensor = c_tensor[is_drum]
-            else:
-                c_logits = c_logits[torch.logical_not(is_drum)]
-                c_tensor = c_tensor[torch.logical_not(is_drum)]
-
-        # Apply softmax to obtain pitch reconstructions
-        pitch_rec = c_logits[..., :constants.N_PITCH_TOKENS]
-        pitch_rec = F.softmax(pitch_rec, dim=-1)
-        pitch_rec = torch.argmax(pitch_rec, dim=-1)
-
-        pitch_true = c_tensor[..., :constants.N_PITCH_TOKENS]
-        pitch_true = torch.argmax(pitch_true, dim=-1)
-
-        # Do not consider PAD tokens when computing accuracies
-        not_pad = (pitch_true != PitchToken.PAD.value)
-
-        correct = (pitch_rec == pitch_true)
-        correct = torch.logical_and(correct, not_pad)
-
-        return torch.sum(correct) / torch.sum(not_pad)
-
-    def _duration_accuracy(self, c_logits, c_tensor):
-
-        # Apply softmax to obtain reconstructed durations
-        dur_rec = c_logits[..., constants.N_PITCH_TOKENS:]
-        dur_rec = F.softmax(dur_rec, dim=-1)
-        dur_rec = torch.argmax(dur_rec, dim=-1)
-
-        dur_true = c_tensor[..., constants.N_PITCH_TOKENS:]
-        dur_true = torch.argmax(dur_true, dim=-1)
-
-        # Do not consider PAD tokens when computing accuracies
-        not_pad = (dur_true != DurationToken.PAD.value)
-
-        correct = (dur_rec == dur_true)
-        correct = torch.logical_and(correct, not_pad)
-
-        return torch.sum(correct) / torch.sum(not_pad)
-
-    def _note_accuracy(self, c_logits, c_tensor):
-
-        # Apply softmax to obtain pitch reconstructions
-        pitch_rec = c_logits[..., :constants.N_PITCH_TOKENS]
-        pitch_rec = F.softmax(pitch_rec, dim=-1)
-        pitch_rec = torch.argmax(pitch_rec, dim=-1)
-
-        pitch_true = c_tensor[..., :constants.N_PITCH_TOKENS]
-        pitch_true = torch.argmax(pitch_true, dim=-1)
-
-        not_pad_p = (pitch_true != PitchToken.PAD.value)
-
-        correct_p = (pitch_rec == pitch_true)
-        correct_p = torch.logical_and(correct_p, not_pad_p)
-
-        dur_rec = c_logits[..., constants.N_PITCH_TOKENS:]
-        dur_rec = F.softmax(dur_rec, dim=-1)
-        dur_rec = torch.argmax(dur_rec, dim=-1)
-
-        dur_true = c_tensor[..., constants.N_PITCH_TOKENS:]
-        dur_true = torch.argmax(dur_true, dim=-1)
-
-        not_pad_d = (dur_true != DurationToken.PAD.value)
-
-        correct_d = (dur_rec == dur_true)
-        correct_d = torch.logical_and(correct_d, not_pad_d)
-
-        note_accuracy = torch.sum(
-            torch.logical_and(correct_p, correct_d)) / torch.sum(not_pad_p)
-
-        return note_accuracy
-
     def _structure_accuracy(self, s_logits, s_tensor):
 
         s_logits = torch.sigmoid(s_logits)
@@ -543,3 +492,7 @@ class PolyphemusTrainer():
 
         print("Accuracies:")
         pprint.pprint(avg_accs, indent=2)
+
+        if self.sample_cache is not None:
+            print("Sample cache:")
+            pprint.pprint(self.sample_cache.stats(), indent=2)